@@ -0,0 +1,106 @@
+"""
+Compare the size of the observations and the extraction time of the
+text of web pages: BeautifulSoup's get_text on the whole page (what
+metaphor_search used to do) versus html_to_text, which skips the
+boilerplate and stops parsing once it has result_tokens of text.
+
+Usage:
+    python benchmarks/html_extraction.py
+    python benchmarks/html_extraction.py --corpus ~/saved_pages --result-tokens 500 --observation-tokens 1500
+
+--corpus is a folder of .html files, for example pages saved from a
+browser. Without it a synthetic corpus is generated: pages with inline
+scripts, a navigation menu, a cookie banner, a sidebar and a footer
+around an article of varying length.
+Observations are made of --per-observation pages, like the 5 results of
+metaphor_search.
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from llm_agent import approx_tokens, cap_entries, html_to_text  # noqa: E402
+
+WORDS = "the of mercury tuna salmon fish level study found higher than in and a to was with species water".split()
+
+
+def sentence(rng):
+    return " ".join(rng.choices(WORDS, k=rng.randint(8, 20))).capitalize() + "."
+
+
+def synthetic_page(rng):
+    script = "var data = " + json.dumps([rng.random() for _ in range(rng.randint(500, 5000))]) + ";"
+    menu = "".join(f'<li><a href="/section/{i}">Section {i}</a></li>' for i in range(rng.randint(20, 200)))
+    article = "".join(
+            f"<h2>{sentence(rng)}</h2>" + "".join(f"<p>{sentence(rng)} <b>{sentence(rng)}</b> {sentence(rng)}</p>" for _ in range(5))
+            for _ in range(rng.randint(2, 60)))
+    return f"""<!DOCTYPE html><html><head><title>{sentence(rng)}</title>
+<style>body {{ margin: 0 }} .nav {{ display: flex }}</style><script>{script}</script></head>
+<body><header><div class="logo">Site</div></header><nav class="nav"><ul>{menu}</ul></nav>
+<div id="cookie-consent">We use cookies. <button>Accept</button></div>
+<main><article><h1>{sentence(rng)}</h1>{article}</article></main>
+<aside class="sidebar"><ul>{menu}</ul></aside>
+<footer><p>Copyright</p><ul>{menu}</ul></footer><script>{script}</script></body></html>"""
+
+
+def bs4_text(html, max_chars):
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, "lxml").get_text().strip()
+
+
+def bench(pages, extract, result_tokens, observation_tokens, per_observation):
+    # each page gets its share of the observation, as in metaphor_search
+    max_chars = min(result_tokens, observation_tokens // per_observation) * 4
+    times = []
+    texts = []
+    for html in pages:
+        t = time.perf_counter()
+        texts.append(extract(html, max_chars))
+        times.append(time.perf_counter() - t)
+    observations = [
+            cap_entries(texts[i:i + per_observation], observation_tokens) if extract is html_to_text
+            else "\n".join(texts[i:i + per_observation])
+            for i in range(0, len(texts), per_observation)]
+    return {
+            "extraction_median_ms": statistics.median(times) * 1000,
+            "extraction_max_ms": max(times) * 1000,
+            "result_tokens_median": statistics.median(approx_tokens(t) for t in texts),
+            "observation_tokens_median": statistics.median(approx_tokens(o) for o in observations),
+            "observation_tokens_max": max(approx_tokens(o) for o in observations),
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=None, help="folder of .html files, synthetic pages if not given")
+    parser.add_argument("--pages", type=int, default=50, help="number of synthetic pages")
+    parser.add_argument("--result-tokens", type=int, default=500)
+    parser.add_argument("--observation-tokens", type=int, default=1500)
+    parser.add_argument("--per-observation", type=int, default=5, help="pages per observation")
+    args = parser.parse_args()
+
+    if args.corpus:
+        pages = [p.read_text(errors="ignore") for p in sorted(Path(args.corpus).glob("*.html"))]
+    else:
+        rng = random.Random(0)
+        pages = [synthetic_page(rng) for _ in range(args.pages)]
+
+    results = {
+            "pages": len(pages),
+            "page_tokens_median": statistics.median(approx_tokens(p) for p in pages),
+            "html_to_text": bench(pages, html_to_text, args.result_tokens, args.observation_tokens, args.per_observation),
+            }
+    try:
+        results["bs4_get_text"] = bench(pages, bs4_text, args.result_tokens, args.observation_tokens, args.per_observation)
+    except ImportError:
+        print("bs4 is not installed, skipping the comparison", file=sys.stderr)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
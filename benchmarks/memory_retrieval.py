@@ -0,0 +1,77 @@
+"""
+Compare the prompt size and latency of giving all the persistent memories
+to the LLM versus only the most relevant ones (see select_memories).
+
+Usage:
+    python benchmarks/memory_retrieval.py
+    python benchmarks/memory_retrieval.py --sizes 10 1000 100000 -k 10 --max-tokens 500
+
+Memories are synthetic sentences, the questions are built from some of
+them so that there is something relevant to retrieve.
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from llm_agent import BM25Index, approx_tokens, select_memories  # noqa: E402
+
+SUBJECTS = ["my cat", "my sister", "my boss", "my car", "my favourite band", "my doctor", "my garden", "my laptop", "my neighbour", "my bank"]
+VERBS = ["is called", "likes", "hates", "was bought in", "lives near", "prefers", "works with", "is allergic to", "reminds me of", "depends on"]
+
+
+def synthetic_memories(n, rng):
+    words = [f"word{i}" for i in range(5000)]
+    return [
+            f"{rng.choice(SUBJECTS)} {rng.choice(VERBS)} {' '.join(rng.choices(words, k=rng.randint(2, 8)))}"
+            for _ in range(n)
+            ]
+
+
+def bench(n, k, max_tokens, n_questions, rng):
+    memories = synthetic_memories(n, rng)
+
+    t = time.perf_counter()
+    index = BM25Index()
+    for mem in memories:
+        index.add(mem)
+    build = time.perf_counter() - t
+
+    questions = [f"What do you know about {' '.join(rng.choice(memories).split()[-2:])}?" for _ in range(n_questions)]
+    latencies = []
+    tokens = []
+    for question in questions:
+        t = time.perf_counter()
+        selected = select_memories(index, question, k, max_tokens)
+        latencies.append(time.perf_counter() - t)
+        tokens.append(sum(approx_tokens(mem) for mem in selected))
+
+    return {
+            "memories": n,
+            "prompt_tokens_all_memories": sum(approx_tokens(mem) for mem in memories),
+            "prompt_tokens_selected_median": statistics.median(tokens),
+            "index_build_s": build,
+            "retrieval_median_ms": statistics.median(latencies) * 1000,
+            "retrieval_max_ms": max(latencies) * 1000,
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000])
+    parser.add_argument("-k", type=int, default=10, help="maximum number of memories selected")
+    parser.add_argument("--max-tokens", type=int, default=500, help="token budget of the selected memories")
+    parser.add_argument("--questions", type=int, default=50, help="number of questions per size")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    results = [bench(n, args.k, args.max_tokens, args.questions, rng) for n in args.sizes]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+Measure the overhead of the plugin itself, without openai or any search
+API: the LLM is a scripted fake chat model and the search tools are fake
+tools that only sleep, both plugged in through SharedResources and the
+tool registry of the configured agent.
+
+Usage:
+    python benchmarks/offline.py
+    python benchmarks/offline.py --output report.json
+    python benchmarks/offline.py --compare report.json
+    python benchmarks/offline.py --llm-latency 0.2 --tool-latency 0.5 -n 3
+
+Timed: cold import (in a subprocess), configuring an agent (the first
+one, that imports langchain, and the following ones), a single ReAct
+answer using one tool, a BigTask of 5 and of 10 steps, loading a large
+file of persistent memories and _validate_answer.
+The report is JSON, --compare prints the ratio to an older report and
+flags the timings that got more than 20% slower.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from startup import IMPORT_SNIPPET, run  # noqa: E402
+
+# llm's user directory, keys etc are set before importing llm
+USER_DIR = tempfile.mkdtemp(prefix="llm_agent_bench_")
+os.environ["LLM_USER_PATH"] = USER_DIR
+os.environ["OPENAI_API_KEY"] = "sk-offline-benchmark"
+
+import llm_agent  # noqa: E402
+
+SEARCH_TOOLS = ["duckduckgo_search", "Wikipedia", "arxiv", "PubMed"]
+
+
+def action(tool, tool_input):
+    return "Action:\n```\n" + json.dumps({"action": tool, "action_input": tool_input}) + "\n```"
+
+
+def script(prompt):
+    "answer of the fake LLM, depending on which prompt it is given"
+    if "generate a few intermediate steps" in prompt:
+        n = int(re.search(r"in (\d+) steps", prompt).group(1))
+        return "\n".join(f"{i}. Find fact number {i} | needs: none" for i in range(1, n + 1))
+    if "check the apparent validity" in prompt:
+        return "VALID:"
+    if "Observation:" in prompt:
+        return action("Final Answer", "The answer is 42.")
+    if "The end goal it to answer this" in prompt or "using a search" in prompt:
+        return action("duckduckgo_search", {"query": "some fact"})
+    if re.search(r"in (\d+) steps", prompt):
+        question = re.search(r"(Do .* in \d+ steps)", prompt).group(1)
+        return action("BigTask", {"question": question})
+    return action("Final Answer", "The answer is 42.")
+
+
+def scripted_chat_model(latency):
+    from langchain.chat_models.base import BaseChatModel
+    from langchain.schema import AIMessage, ChatGeneration, ChatResult
+
+    class ScriptedChatModel(BaseChatModel):
+        latency: float = 0.0
+        streaming: bool = False
+        model_name: str = "scripted"
+
+        @property
+        def _llm_type(self):
+            return "scripted"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            time.sleep(self.latency)
+            prompt = messages[-1].content
+            text = script(prompt)
+            usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4}
+            usage["total_tokens"] = sum(usage.values())
+            return ChatResult(
+                    generations=[ChatGeneration(message=AIMessage(content=text))],
+                    llm_output={"token_usage": usage, "model_name": self.model_name},
+                    )
+
+    return ScriptedChatModel(latency=latency)
+
+
+def fake_tool(name, latency):
+    from langchain.tools import StructuredTool
+
+    def search(query: str) -> str:
+        time.sleep(latency)
+        return f"{name} says that fact is true."
+
+    return StructuredTool.from_function(search, name=name, description=f"fake {name}")
+
+
+class OfflineResources(llm_agent.SharedResources):
+    def __init__(self, llm_latency):
+        super().__init__()
+        self.llm_latency = llm_latency
+
+    def get_llm(self, model, temperature, cache, verbose, timeout=None, streaming=False):
+        with self.lock:
+            if "scripted" not in self.llms:
+                self.llms["scripted"] = scripted_chat_model(self.llm_latency)
+            return self.llms["scripted"]
+
+    def get_bucket(self, provider, rpm, burst=1):
+        # the fake tools have no rate limit to respect
+        return llm_agent.TokenBucket(1e9, 1e9)
+
+
+def timeit(func, n):
+    times = []
+    for _ in range(n):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    return {"median_s": statistics.median(times), "min_s": min(times)}
+
+
+def bench(args):
+    results = {}
+    imports = [run(IMPORT_SNIPPET, REPO)["import"] for _ in range(args.n)]
+    results["cold_import"] = {"median_s": statistics.median(imports), "min_s": min(imports)}
+
+    pool = llm_agent.AgentPool(shared=OfflineResources(args.llm_latency))
+    options = llm_agent.Agent.Options(quiet=True, tool_cache=False, llm_cache=False).model_dump()
+    sessions = iter(range(10**6))
+
+    def configure(opts=options):
+        agent = llm_agent.ConfiguredAgent(opts, pool.shared, pool.shared.get_chat_history(next(sessions)))
+        for name in SEARCH_TOOLS:
+            agent.registry.loaded[name] = fake_tool(name, args.tool_latency)
+        return agent
+
+    results["configure_first"] = timeit(configure, 1)
+    results["configure"] = timeit(configure, args.n)
+
+    def answer(agent, question):
+        agent.chat_memory.clear()
+        agent.answer(question)
+
+    react = configure(dict(options, bigtask_tool=False))
+    results["react_answer"] = timeit(lambda: answer(react, "What is that fact? Answer using a search."), args.n)
+
+    bigtask = configure()
+    for steps in (5, 10):
+        results[f"bigtask_{steps}_steps"] = timeit(lambda: answer(bigtask, f"Do this task in {steps} steps."), args.n)
+
+    answerdict = {"output": "The answer is 42.", "intermediate_steps": []}
+    results["validate_answer"] = timeit(lambda: bigtask._validate_answer("What is that fact?", answerdict), args.n)
+
+    memories = [{"timestamp": 1700000000 + i, "message": f"memory number {i} about topic {i % 97}"} for i in range(args.memories)]
+
+    def migrate():
+        shared = llm_agent.SharedResources()
+        (shared.agent_dir() / "bench.json").write_text(json.dumps(memories))
+        shared.get_memory_store().db.execute("DELETE FROM memories WHERE user = 'bench'")
+        shared.get_memory_index("bench", verbose=False)
+
+    def load():
+        shared = llm_agent.SharedResources()
+        index = shared.get_memory_index("bench", verbose=False)
+        llm_agent.select_memories(index, "what about topic 12?", llm_agent.DEFAULT_USER_MEMORY_K, llm_agent.DEFAULT_USER_MEMORY_TOKENS)
+
+    results[f"memory_migrate_{args.memories}"] = timeit(migrate, 1)
+    results[f"memory_load_{args.memories}"] = timeit(load, args.n)
+    return results
+
+
+def environment():
+    import langchain
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True, text=True).stdout.strip()
+    except Exception:
+        commit = None
+    return {
+            "commit": commit,
+            "python": platform.python_version(),
+            "langchain": langchain.__version__,
+            "platform": platform.platform(),
+            }
+
+
+def compare(results, old):
+    for name, res in results.items():
+        if name not in old:
+            continue
+        ratio = res["median_s"] / max(old[name]["median_s"], 1e-9)
+        flag = "  <-- slower" if ratio > 1.2 else ""
+        print(f"{name:28s} {old[name]['median_s']:9.4f}s -> {res['median_s']:9.4f}s  x{ratio:.2f}{flag}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=5, help="number of measurements of each benchmark")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds slept by the fake LLM per call")
+    parser.add_argument("--tool-latency", type=float, default=0.05, help="seconds slept by the fake tools per call")
+    parser.add_argument("--memories", type=int, default=10000, help="number of persistent memories loaded")
+    parser.add_argument("--output", default=None, help="path of the JSON report, printed if not given")
+    parser.add_argument("--compare", default=None, help="JSON report to compare against")
+    args = parser.parse_args()
+
+    # the agent prints its steps
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = bench(args)
+
+    report = {
+            "environment": environment(),
+            "parameters": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+            "results": results,
+            }
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        compare(results, json.loads(Path(args.compare).read_text())["results"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Measure the startup cost of the plugin: the time taken by
+`import llm_agent` (paid by every llm invocation because llm imports all
+its plugins) and the latency of the first answer of the agent.
+
+Usage:
+    python benchmarks/startup.py
+    python benchmarks/startup.py --ref baseline
+    python benchmarks/startup.py --question "What is 12*7?"
+
+--ref can be any git ref, the llm_agent.py of that ref is benchmarked
+next to the one of the working tree so that before/after can be compared.
+The first answer latency is only measured if --question is given as it
+needs an openai key and costs a few tokens.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+
+# the module is loaded from its path so that an installed copy of the
+# plugin can't shadow the one being benchmarked
+LOAD = """
+import importlib.util, sys
+spec = importlib.util.spec_from_file_location("llm_agent", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+sys.modules["llm_agent"] = module
+spec.loader.exec_module(module)
+"""
+
+IMPORT_SNIPPET = """
+import time, json
+t = time.perf_counter()
+""" + LOAD + """
+print(json.dumps({"import": time.perf_counter() - t}))
+"""
+
+ANSWER_SNIPPET = """
+import time, json, sys
+t = time.perf_counter()
+""" + LOAD + """
+import llm
+model = llm.get_model("agent")
+answer = model.prompt(sys.argv[2], quiet=True).text()
+print(json.dumps({"first_answer": time.perf_counter() - t}))
+"""
+
+
+def run(snippet, src, *args):
+    out = subprocess.run(
+            [sys.executable, "-c", snippet, str(Path(src) / "llm_agent.py"), *args],
+            capture_output=True,
+            text=True,
+            check=True,
+            )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def bench(src, n, question):
+    imports = [run(IMPORT_SNIPPET, src)["import"] for _ in range(n)]
+    res = {
+            "import_median_s": statistics.median(imports),
+            "import_min_s": min(imports),
+            }
+    if question:
+        res["first_answer_s"] = run(ANSWER_SNIPPET, src, question)["first_answer"]
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ref", default=None, help="git ref to compare against")
+    parser.add_argument("-n", type=int, default=5, help="number of import measurements")
+    parser.add_argument("--question", default=None, help="question used to measure the first answer latency")
+    args = parser.parse_args()
+
+    results = {"working_tree": bench(REPO, args.n, args.question)}
+
+    if args.ref:
+        with tempfile.TemporaryDirectory() as tmp:
+            code = subprocess.run(
+                    ["git", "show", f"{args.ref}:llm_agent.py"],
+                    cwd=REPO,
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                    ).stdout
+            (Path(tmp) / "llm_agent.py").write_text(code)
+            results[args.ref] = bench(tmp, args.n, args.question)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Compare the prompt of BigTask's agent when it gets every tool and when
+it only gets the step_tools tools most relevant to each step (see
+ToolSelector).
+
+Usage:
+    python benchmarks/tool_selection.py
+    python benchmarks/tool_selection.py --step-tools 3 --files
+    python benchmarks/tool_selection.py --model gpt-3.5-turbo-1106
+
+The agents are configured offline like in offline.py and the tokens of
+their prompt, that are sent again at every ReAct iteration, are counted
+for a set of typical steps, along with the time taken to select the
+tools. --model also times one real iteration of each agent on each step,
+it needs an openai key and costs a few tokens.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+# offline.py replaces the openai key by a fake one
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from offline import OfflineResources, llm_agent  # noqa: E402
+
+STEPS = [
+        "Find recent papers about mercury levels in tuna",
+        "Look up biomedical literature on the health effects of eating salmon",
+        "Find the population of France",
+        "Compute the average of the values found in steps 1 and 2",
+        "Open the website of the WHO and click on the latest report",
+        "Read the urls found in step 2 and summarize them",
+        "Find who the current president of the european commission is",
+        "Ask the user which country they mean",
+        "Read the file notes.txt and write a summary to summary.txt",
+        "Search the news for the price of bitcoin today",
+        ]
+
+
+def configure(shared, step_tools, files):
+    options = llm_agent.Agent.Options(quiet=True, tool_cache=False, llm_cache=False, files_tool=files, step_tools=step_tools)
+    return llm_agent.ConfiguredAgent(options.model_dump(), shared, shared.get_chat_history(f"tools_{step_tools}"))
+
+
+def system_prompt(executor):
+    "the system message of the structured chat agent, with the tools"
+    return executor.agent.llm_chain.prompt.messages[0].prompt.template
+
+
+def iteration(model, executor, step):
+    "seconds and prompt tokens of one call to model with the prompt of executor"
+    from langchain.chat_models import ChatOpenAI
+    from langchain.schema import HumanMessage, SystemMessage
+    llm = ChatOpenAI(model_name=model, temperature=0, max_tokens=50, cache=False, openai_api_key=OPENAI_API_KEY)
+    t = time.perf_counter()
+    result = llm.generate([[SystemMessage(content=system_prompt(executor)), HumanMessage(content=step)]])
+    return time.perf_counter() - t, result.llm_output["token_usage"]["prompt_tokens"]
+
+
+def bench(args):
+    shared = OfflineResources(0)
+    every = configure(shared, None, args.files)
+    selecting = configure(shared, args.step_tools, args.files)
+
+    results = {"steps": []}
+    for step in STEPS:
+        t = time.perf_counter()
+        executor = selecting._step_agent(step)
+        selection = time.perf_counter() - t
+        res = {
+                "step": step,
+                "tools": [t.name for t in executor.tools],
+                "prompt_tokens_all_tools": llm_agent.approx_tokens(system_prompt(every._step_agent(step))),
+                "prompt_tokens_selected": llm_agent.approx_tokens(system_prompt(executor)),
+                "selection_ms": selection * 1000,
+                }
+        if args.model:
+            res["iteration_s_all_tools"], res["openai_prompt_tokens_all_tools"] = iteration(args.model, every._step_agent(step), step)
+            res["iteration_s_selected"], res["openai_prompt_tokens_selected"] = iteration(args.model, executor, step)
+        results["steps"].append(res)
+
+    steps = results["steps"]
+    results["summary"] = {
+            "tools": len(every.satools),
+            "step_tools": args.step_tools,
+            "prompt_tokens_all_tools_median": statistics.median(s["prompt_tokens_all_tools"] for s in steps),
+            "prompt_tokens_selected_median": statistics.median(s["prompt_tokens_selected"] for s in steps),
+            "agents_built": len([k for k in selecting.agents if k[0] == "step"]),
+            }
+    if args.model:
+        results["summary"]["iteration_s_all_tools_median"] = statistics.median(s["iteration_s_all_tools"] for s in steps)
+        results["summary"]["iteration_s_selected_median"] = statistics.median(s["iteration_s_selected"] for s in steps)
+    # the first selection also builds the agent
+    again = []
+    for step in STEPS:
+        t = time.perf_counter()
+        selecting._step_agent(step)
+        again.append(time.perf_counter() - t)
+    results["summary"]["cached_selection_median_ms"] = statistics.median(again) * 1000
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--step-tools", type=int, default=llm_agent.DEFAULT_STEP_TOOLS, help="tools selected for each step")
+    parser.add_argument("--files", action="store_true", help="also enable the files tools")
+    parser.add_argument("--model", default=None, help="openai model used to time one iteration of the agents")
+    args = parser.parse_args()
+
+    # the agent prints its tools
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = bench(args)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
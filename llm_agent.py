@@ -1,37 +1,36 @@
 import textwrap
+import ast
 import sys
 from datetime import datetime
-from bs4 import BeautifulSoup
 import time
-from tqdm import tqdm
+import threading
+import asyncio
+import queue
+import re
+import sqlite3
+import math
+import heapq
+import random
+import itertools
+import functools
+import hashlib
+import contextvars
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict
 from textwrap import dedent
 import json
 import llm
 import click
 import os
+import socket
+import shlex
 from typing import Optional
 from pydantic import field_validator, Field
 
-from langchain.globals import set_verbose, set_debug
-from langchain.agents import load_tools
-from langchain.agents.initialize import initialize_agent
-from langchain.agents.agent_types import AgentType
-from langchain.agents.agent_toolkits import FileManagementToolkit
-from langchain.tools import ShellTool
-from langchain.agents.agent_toolkits import PlayWrightBrowserToolkit
-from langchain.tools.playwright.utils import create_sync_playwright_browser
-from langchain.chains import LLMChain
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import PromptTemplate
-from langchain.memory import ConversationBufferMemory
-from langchain.memory import ConversationBufferWindowMemory
-from langchain.callbacks import get_openai_callback
-from langchain.tools import tool
-from langchain.tools import PubmedQueryRun
-from langchain.tools.tavily_search import TavilySearchResults
-from langchain.utilities.tavily_search import TavilySearchAPIWrapper
-
-from metaphor_python import Metaphor
+# langchain, playwright, tavily, pubmed, metaphor etc are only imported
+# when the agent is actually configured: llm imports every plugin on
+# each invocation so anything imported here slows down all llm commands.
 
 DEFAULT_MODEL = "gpt-3.5-turbo-1106"
 DEFAULT_TEMP = 0
@@ -41,16 +40,2832 @@ DEFAULT_BIGTASK = True
 DEFAULT_FILES = False
 DEFAULT_SHELL = False
 DEFAULT_VALIDATE_SUBTASK = False
+DEFAULT_BIGTASK_WORKERS = 3
+DEFAULT_POOL_SIZE = 4  # number of configured agents kept in memory
+STREAM_OBSERVATION_CHARS = 500  # observations are truncated when streamed
+DEFAULT_TOOL_CACHE = True
+DEFAULT_LLM_CACHE = None  # None means only if the temperature is 0
+DEFAULT_LLM_CACHE_SIZE = 5000  # number of cached completions
+DEFAULT_USER_MEMORY_K = 10
+DEFAULT_USER_MEMORY_TOKENS = 500
+DEFAULT_CHAT_MEMORY_TOKENS = None  # None means unlimited
+DEFAULT_SUB_CHAT_MEMORY_TOKENS = None
+DEFAULT_TRACE = False
+DEFAULT_MAX_TOKENS = None  # None means unlimited
+DEFAULT_MAX_COST = None
+DEFAULT_RESUME = False
+DEFAULT_OPENAI_RPM = None  # None means no limit besides openai's
+ROLES = ("agent", "planner", "step", "validator", "synthesis")  # see the routes option
+DEFAULT_ROUTES = None  # None means openaimodel and temperature for every role
+DEFAULT_FALLBACK_MODEL = None
+DEFAULT_FALLBACK_TIMEOUT = 30  # seconds before a call falls back to fallback_model
+DEFAULT_STEP_TOOLS = 5  # tools given to BigTask's agent for a step, None for all
+ALWAYS_SELECTED_TOOLS = ("meta_search",)  # given for every step, on top of the others
+DEFAULT_TOOL_CACHE_SIZE = 10000  # number of cached tool results
+# requests per minute allowed to the search tools, shared by all agents
+TOOL_RPM = {
+        "duckduckgo_search": 20,
+        "tavily_search_results_json": 60,
+        "metaphor_search": 60,
+        "Wikipedia": 60,
+        "arxiv": 20,
+        "PubMed": 180,
+        }
+DEFAULT_TOOL_BURST = 3  # calls allowed at once before the rate applies
+DEFAULT_RETRIES = 3  # retries of the transient errors of the search tools
+DEFAULT_STEP_RETRIES = 1  # retries of a failed BigTask step
+# answers of BigTask steps that are checked by the LLM validator, see looks_valid
+MIN_VALID_ANSWER_CHARS = 20
+DOUBTFUL_ANSWER_RE = re.compile(
+        r"agent stopped|step not finished|\berror\b|failed|unable to|sorry|not (able|possible) to|"
+        r"i (don't|do not|cannot|can't|couldn't|could not) (know|find|answer|access|determine)|"
+        r"no (relevant )?(results|information|data) (was |were )?(found|available)",
+        re.IGNORECASE)
+DEFAULT_RETRY_BASE_DELAY = 1  # seconds, doubled at each retry
+DEFAULT_RETRY_MAX_DELAY = 30
+DEFAULT_LLM_RETRIES = 6  # done by the openai client, with backoff and Retry-After
+DEFAULT_BREAKER_THRESHOLD = 3  # consecutive failures before a tool is left out
+DEFAULT_BREAKER_COOLDOWN = 300  # seconds
+DEFAULT_META_SEARCH = True
+DEFAULT_META_SEARCH_TIMEOUT = 10  # seconds given to each search tool
+DEFAULT_OBSERVATION_TOKENS = 1500  # size of the observations of the web tools
+DEFAULT_RESULT_TOKENS = 500  # size of each search result or page in them
+DEFAULT_BROWSER_PAGES = 4  # pages loaded at once by the browser
+DEFAULT_BROWSER_BLOCK_RESOURCES = True
+BLOCKED_RESOURCES = ("image", "font", "media")  # not loaded if blocking
+DEFAULT_PAGE_TIMEOUT = 20  # seconds to load a page
+MAX_FETCHED_PAGES = 10  # pages loaded by a call to fetch_pages
+PAGE_TEXT_CHARS = 20000  # text of a page kept by the browser and the cache
+HTML_CHUNK_CHARS = 16384  # html is parsed by chunks until there's enough text
+# elements skipped when extracting the text of html
+BOILERPLATE_TAGS = {
+        "script", "style", "noscript", "template", "svg", "canvas", "iframe",
+        "nav", "header", "footer", "aside", "form", "button", "select", "dialog",
+        }
+BOILERPLATE_ROLES = {"navigation", "banner", "contentinfo", "complementary", "search", "dialog", "menu"}
+BOILERPLATE_RE = re.compile(
+        r"(^|[\s_-])(nav|navbar|menu|footer|sidebar|cookies?|consent|banner|advert|ads|social|share|newsletter|popup|modal|breadcrumbs?)([\s_-]|$)",
+        re.IGNORECASE)
+BLOCK_TAGS = {
+        "p", "div", "br", "li", "ul", "ol", "tr", "table", "section", "article", "main",
+        "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote", "dd", "dt", "hr",
+        }
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+PAGE_CACHE_TTL = 24 * 3600
+DEFAULT_PAGE_CACHE_SIZE = 1000
+# time to live in seconds of the cached results, tools that are not listed
+# here (calculator, human, browser, files, shell...) are never cached
+TOOL_CACHE_TTL = {
+        "duckduckgo_search": 24 * 3600,
+        "tavily_search_results_json": 24 * 3600,
+        "metaphor_search": 7 * 24 * 3600,
+        "Wikipedia": 7 * 24 * 3600,
+        "arxiv": 30 * 24 * 3600,
+        "PubMed": 30 * 24 * 3600,
+        }
+# words matched by the ToolSelector on top of the name and description of
+# the tools, which are too short to match how the steps are worded
+TOOL_KEYWORDS = {
+        "Calculator": "calculate compute arithmetic multiply divide add subtract sum total average percentage ratio convert times number",
+        "duckduckgo_search": "search web internet news recent latest current today price find look up",
+        "tavily_search_results_json": "search web internet news recent latest current find look up",
+        "metaphor_search": "search web internet article blog find look up",
+        "Wikipedia": "history definition biography country city population encyclopedia born capital",
+        "arxiv": "paper preprint research study publication scientific physics math machine learning",
+        "PubMed": "paper study research clinical disease drug medical health biology species publication",
+        "fetch_pages": "url link website page read download open visit",
+        "navigate_browser": "open website visit browse page url link",
+        "click_element": "click button form",
+        "human": "ask user clarify confirm preference opinion",
+        "read_file": "file document folder directory code",
+        "write_file": "save create edit modify file document code",
+        "terminal": "shell command run execute bash install script program",
+        }
+STOPWORDS = frozenset("""
+        a about an and are as at be by can do does for from has have he her his how i if in into is it its
+        me my of on or our she so than that the their them then there these they this to was we were what
+        when where which who why will with you your
+        """.split())
+
+
+class FinalAnswerStream:
+    """Incrementally extract the final answer from the tokens of the
+    JSON blob written by the structured chat agent, so that it can be
+    streamed while the model is still generating it."""
+    pattern = re.compile(r'"action"\s*:\s*"Final Answer"\s*,\s*"action_input"\s*:\s*"')
+
+    def __init__(self):
+        self.buffer = ""
+        self.started = False
+        self.finished = False
+        self.escape = ""  # escape sequence being read, e.g. '\\u00'
+        self.surrogate = ""  # first half of a surrogate pair, e.g. of an emoji
+
+    def feed(self, token):
+        "returns the part of the final answer contained in token"
+        if self.finished:
+            return ""
+        if not self.started:
+            self.buffer += token
+            match = self.pattern.search(self.buffer)
+            if not match:
+                return ""
+            self.started = True
+            token = self.buffer[match.end():]
+
+        answer = ""
+        for char in token:
+            if self.escape:
+                self.escape += char
+                # \uXXXX has 4 hex digits
+                if self.escape[1] == "u" and len(self.escape) < 6:
+                    continue
+                answer += self.join(self.unescape(self.escape))
+                self.escape = ""
+            elif char == "\\":
+                self.escape = char
+            elif char == '"':
+                self.finished = True
+                break
+            else:
+                answer += self.join(char)
+        return answer
+
+    @staticmethod
+    def unescape(escape):
+        "character of a JSON escape sequence"
+        try:
+            return json.loads(f'"{escape}"')
+        except json.JSONDecodeError:
+            return escape[1:]
+
+    def join(self, char):
+        """char, or nothing if it's the first half of a surrogate pair
+        (\\ud83d\\ude00...) and the whole character with the second half"""
+        if "\ud800" <= char <= "\udbff":
+            self.surrogate = char
+            return ""
+        if self.surrogate:
+            pair, self.surrogate = self.surrogate + char, ""
+            if "\udc00" <= char <= "\udfff":
+                return pair.encode("utf-16", "surrogatepass").decode("utf-16")
+            return "\ufffd" + char
+        return char
+
+
+def stream_handler(put):
+    """Create a langchain callback handler that calls put(text) for each
+    tool call, observation and BigTask step answer as soon as they are
+    available, as well as for each token of the final answer."""
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    class StreamHandler(BaseCallbackHandler):
+        def __init__(self):
+            self.parents = {}
+            self.tool_runs = set()
+            self.agent_runs = set()
+            self.answers = {}
+            self.streamed_answer = False
+
+        def depth(self, run_id):
+            "number of tools (i.e. BigTask) the run is nested in"
+            depth = 0
+            while run_id is not None:
+                run_id = self.parents.get(run_id)
+                if run_id in self.tool_runs:
+                    depth += 1
+            return depth
+
+        def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+            self.parents[run_id] = parent_run_id
+            if (serialized or {}).get("id", [""])[-1] == "AgentExecutor":
+                self.agent_runs.add(run_id)
+
+        def on_chain_end(self, outputs, *, run_id, **kwargs):
+            if run_id in self.agent_runs and self.depth(run_id) and "output" in outputs:
+                indent = "    " * self.depth(run_id)
+                put(f"{indent}Step answer: {outputs['output']}\n")
+
+        def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+            self.parents[run_id] = parent_run_id
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+            self.parents[run_id] = parent_run_id
+
+        def on_llm_new_token(self, token, *, run_id, **kwargs):
+            if self.depth(run_id):
+                return
+            if run_id not in self.answers:
+                self.answers[run_id] = FinalAnswerStream()
+            answer = self.answers[run_id].feed(token)
+            if answer:
+                if not self.streamed_answer:
+                    answer = "\n-> " + answer
+                    self.streamed_answer = True
+                put(answer)
+
+        def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs):
+            self.parents[run_id] = parent_run_id
+            self.tool_runs.add(run_id)
+
+        def on_tool_end(self, output, *, run_id, parent_run_id=None, **kwargs):
+            # the lazily loaded tools call the real tool inside the proxy
+            if parent_run_id in self.tool_runs:
+                return
+            output = str(output)
+            if len(output) > STREAM_OBSERVATION_CHARS:
+                output = output[:STREAM_OBSERVATION_CHARS] + "[...]"
+            indent = "    " * self.depth(run_id)
+            put(f"{indent}  Observation: {output}\n")
+
+        def on_agent_action(self, action, *, run_id, **kwargs):
+            indent = "    " * self.depth(run_id)
+            put(f"{indent}* {action.tool}: {action.tool_input}\n")
+
+    return StreamHandler()
+
+
+class BudgetExceeded(Exception):
+    "raised by the budget callback handler to stop the agent"
+
+    def __init__(self, reason, budget):
+        super().__init__(reason)
+        self.budget = budget
+
+
+class Budget:
+    """Deadline and optional token and dollar limits of a question. A
+    budget split from another (e.g. for a BigTask step) has its own
+    deadline but also counts against, and is exceeded with, its parent.
+    A cancelled budget stops the runs using it or a budget split from it.
+    The budget of the running question is in CURRENT_BUDGET."""
+
+    def __init__(self, timeout=None, max_tokens=None, max_cost=None, parent=None):
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.parent = parent
+        self.tokens = 0
+        self.cost = 0.0
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        "seconds left, None if unlimited"
+        remaining = [b.deadline - time.monotonic() for b in self.chain() if b.deadline is not None]
+        return min(remaining) if remaining else None
+
+    def chain(self):
+        budget = self
+        while budget is not None:
+            yield budget
+            budget = budget.parent
+
+    def split(self, parts):
+        "child budget with a 1/parts share of the remaining time"
+        remaining = self.remaining()
+        return Budget(remaining / parts if remaining is not None else None, parent=self)
+
+    def add(self, tokens, cost):
+        for budget in self.chain():
+            with budget.lock:
+                budget.tokens += tokens
+                budget.cost += cost
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        "raises BudgetExceeded if this budget or one of its parents is exhausted"
+        for budget in self.chain():
+            if budget.cancelled:
+                raise BudgetExceeded("Cancelled", budget)
+            if budget.deadline is not None and time.monotonic() > budget.deadline:
+                raise BudgetExceeded("Ran out of time", budget)
+            if budget.max_tokens is not None and budget.tokens >= budget.max_tokens:
+                raise BudgetExceeded(f"Used the {budget.max_tokens} tokens of the budget", budget)
+            if budget.max_cost is not None and budget.cost >= budget.max_cost:
+                raise BudgetExceeded(f"Spent the ${budget.max_cost} of the budget", budget)
+
+
+CURRENT_BUDGET = contextvars.ContextVar("budget", default=None)
+
+
+def llm_usage(response):
+    "model, prompt tokens, completion tokens and cost of an LLMResult"
+    from langchain.callbacks.openai_info import get_openai_token_cost_for_model
+    output = response.llm_output or {}
+    usage = output.get("token_usage", {})
+    model = output.get("model_name")
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    try:
+        cost = (get_openai_token_cost_for_model(model, prompt_tokens)
+                + get_openai_token_cost_for_model(model, completion_tokens, is_completion=True))
+    except Exception:
+        # unknown model
+        cost = 0.0
+    return model, prompt_tokens, completion_tokens, cost
+
+
+def budget_handler():
+    """Create a langchain callback handler that stops the run by raising
+    BudgetExceeded before any LLM call, tool call or chain once the
+    budget of CURRENT_BUDGET is exhausted, and counts the tokens and cost
+    of the LLM calls against it."""
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    class BudgetHandler(BaseCallbackHandler):
+        raise_error = True
+        # in the caller's thread, to see its CURRENT_BUDGET
+        run_inline = True
+
+        def check(self, *args, **kwargs):
+            budget = CURRENT_BUDGET.get()
+            if budget is not None:
+                budget.check()
+
+        on_chain_start = on_llm_start = on_chat_model_start = on_tool_start = check
+
+        def on_llm_end(self, response, **kwargs):
+            budget = CURRENT_BUDGET.get()
+            if budget is None:
+                return
+            _, prompt_tokens, completion_tokens, cost = llm_usage(response)
+            budget.add(prompt_tokens + completion_tokens, cost)
+
+    return BudgetHandler()
+
+
+class TokenBucket:
+    """Allows rate calls per second on average, with bursts of up to
+    capacity calls. Shared by all the agents calling the same provider."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        "take a token and return the number of seconds to wait before using it"
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def aacquire(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class CircuitBreaker:
+    """Opened after threshold consecutive failures of a tool, which is
+    then left out of the agents for cooldown seconds. After that it's
+    available again but a single new failure reopens the breaker."""
+
+    def __init__(self, threshold=DEFAULT_BREAKER_THRESHOLD, cooldown=DEFAULT_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def available(self):
+        with self.lock:
+            return self.opened is None or time.monotonic() - self.opened >= self.cooldown
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.monotonic()
+
+
+def retry_after(err):
+    "seconds to wait given by the Retry-After header of the response of err, if any"
+    headers = getattr(getattr(err, "response", None), "headers", None)
+    try:
+        return float(headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def is_transient(err):
+    "True for rate limits, server errors, timeouts and connection errors"
+    status = getattr(err, "status_code", None) or getattr(getattr(err, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    name = type(err).__name__.lower()
+    return any(s in name for s in ("ratelimit", "timeout", "connection", "unavailable"))
+
+
+def retry_delay(err, attempt, retries, retry_if):
+    """Seconds to wait before retrying after err: exponential backoff with
+    full jitter, but at least the Retry-After of the error. Raises err
+    if it shouldn't be retried or if the question's budget doesn't leave
+    the time to wait."""
+    if attempt >= retries or isinstance(err, BudgetExceeded) or not retry_if(err):
+        raise err
+    delay = random.uniform(0, min(DEFAULT_RETRY_MAX_DELAY, DEFAULT_RETRY_BASE_DELAY * 2 ** attempt))
+    delay = max(delay, retry_after(err) or 0)
+    budget = CURRENT_BUDGET.get()
+    remaining = budget.remaining() if budget is not None else None
+    if remaining is not None and delay >= remaining:
+        raise err
+    print(f"Error {err}, retrying after {delay:.1f}s")
+    return delay
+
+
+def with_retries(func, retries=DEFAULT_RETRIES, retry_if=is_transient):
+    "returns func(), retrying it according to retry_delay"
+    for attempt in itertools.count():
+        try:
+            return func()
+        except Exception as err:
+            time.sleep(retry_delay(err, attempt, retries, retry_if))
+
+
+async def awith_retries(func, retries=DEFAULT_RETRIES, retry_if=is_transient):
+    "async version of with_retries, func returning an awaitable"
+    for attempt in itertools.count():
+        try:
+            return await func()
+        except Exception as err:
+            await asyncio.sleep(retry_delay(err, attempt, retries, retry_if))
+
+
+class ToolFailure(str):
+    "observation returned when a tool failed or couldn't be loaded, never cached"
+
+
+def resilient_tool(tool, bucket, breaker):
+    """returns tool rate limited by bucket, with its transient errors
+    retried and its failures reported to breaker. Errors that remain
+    are given to the agent as the observation so that it can try
+    another tool."""
+
+    def failed(err):
+        breaker.failure()
+        return ToolFailure(f"The tool {tool.name} failed ({err}), try another tool.")
+
+    def run(tool_input, callbacks):
+        def call():
+            bucket.acquire()
+            return tool.run(tool_input, callbacks=callbacks)
+
+        try:
+            output = with_retries(call)
+        except BudgetExceeded:
+            raise
+        except Exception as err:
+            return failed(err)
+        breaker.success()
+        return output
+
+    async def arun(tool_input, callbacks):
+        async def call():
+            await bucket.aacquire()
+            return await arun_tool(tool, tool_input, callbacks)
+
+        try:
+            output = await awith_retries(call)
+        except BudgetExceeded:
+            raise
+        except Exception as err:
+            return failed(err)
+        breaker.success()
+        return output
+
+    return wrap_tool(tool, run, arun)
+
+
+def parse_routes(routes):
+    """Parse the routes option, e.g. 'planner=gpt-3.5-turbo-1106@0,synthesis=gpt-4',
+    into a dict mapping roles to (model, temperature), temperature being
+    None if not given. The roles not given are left out."""
+    parsed = {}
+    for route in (routes or "").split(","):
+        route = route.strip()
+        if not route:
+            continue
+        assert "=" in route, f"Invalid route '{route}', expected role=model or role=model@temperature"
+        role, model = (x.strip() for x in route.split("=", 1))
+        assert role in ROLES, f"Invalid role '{role}' in routes, must be one of {ROLES}"
+        temperature = None
+        if "@" in model:
+            model, temperature = model.rsplit("@", 1)
+            temperature = float(temperature)
+        assert model, f"Missing model for role '{role}' in routes"
+        parsed[role] = (model, temperature)
+    return parsed
+
+
+def tag_role(tags):
+    """role given by the tags of a run: its last 'role:' tag, the inherited
+    tags coming first. The runs without one have the role of their parent."""
+    roles = [tag[5:] for tag in tags or [] if tag.startswith("role:")]
+    return roles[-1] if roles else None
+
+
+class RoleStats:
+    """Number of calls, latency, tokens and cost of the LLM calls of each
+    role (see ROLES) and which models answered them, to tune the routes
+    option. Filled by role_stats_handler."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.roles = {}
+
+    def add(self, role, seconds, model=None, tokens=0, cost=0.0, error=False):
+        with self.lock:
+            stats = self.roles.setdefault(role, {"calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0, "tokens": 0, "cost": 0.0, "models": {}})
+            stats["calls"] += 1
+            stats["errors"] += error
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["tokens"] += tokens
+            stats["cost"] += cost
+            if model:
+                stats["models"][model] = stats["models"].get(model, 0) + 1
+
+    @property
+    def stats(self):
+        lines = []
+        with self.lock:
+            for role in sorted(self.roles, key=lambda r: ROLES.index(r) if r in ROLES else len(ROLES)):
+                st = self.roles[role]
+                models = ", ".join(f"{model}: {n}" for model, n in sorted(st["models"].items()))
+                lines.append(
+                        f"  {role}: {st['calls']} calls, {st['errors']} errors, "
+                        f"{st['seconds'] / st['calls']:.2f}s on average, {st['max_seconds']:.2f}s max, "
+                        f"{st['tokens']} tokens, ${st['cost']:.4f} ({models})")
+        return "LLM calls by role:\n" + "\n".join(lines)
+
+
+def role_stats_handler(stats):
+    "Create a langchain callback handler reporting the LLM calls to a RoleStats"
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    class RoleStatsHandler(BaseCallbackHandler):
+        def __init__(self):
+            # role of the chains and tools being run
+            self.roles = {}
+            self.started = {}
+
+        def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, **kwargs):
+            self.roles[run_id] = tag_role(tags) or self.roles.get(parent_run_id)
+
+        def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, tags=None, **kwargs):
+            self.roles[run_id] = tag_role(tags) or self.roles.get(parent_run_id)
+
+        def on_chain_end(self, outputs, *, run_id, **kwargs):
+            self.roles.pop(run_id, None)
+
+        on_chain_error = on_tool_end = on_tool_error = on_chain_end
+
+        def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, tags=None, **kwargs):
+            role = tag_role(tags) or self.roles.get(parent_run_id) or "agent"
+            self.started[run_id] = (role, time.perf_counter())
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, tags=None, **kwargs):
+            self.on_llm_start(serialized, None, run_id=run_id, parent_run_id=parent_run_id, tags=tags)
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            if run_id not in self.started:
+                return
+            role, start = self.started.pop(run_id)
+            # openai doesn't report the token usage when streaming, see StreamingChatOpenAI
+            model, prompt_tokens, completion_tokens, cost = llm_usage(response)
+            stats.add(role, time.perf_counter() - start, model, prompt_tokens + completion_tokens, cost)
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            if run_id not in self.started:
+                return
+            role, start = self.started.pop(run_id)
+            stats.add(role, time.perf_counter() - start, error=True)
+
+    return RoleStatsHandler()
+
+
+class Histogram:
+    "prometheus histogram with one series per label value"
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf"))
+
+    def __init__(self, name, label, help):
+        self.name = name
+        self.label = label
+        self.help = help
+        self.series = {}
+
+    def observe(self, value, label):
+        counts, total = self.series.get(label, ([0] * len(self.buckets), 0.0))
+        counts = [c + (value <= b) for c, b in zip(counts, self.buckets)]
+        self.series[label] = (counts, total + value)
+
+    def text(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label, (counts, total) in sorted(self.series.items()):
+            lab = f'{self.label}="{label}"'
+            for c, b in zip(counts, self.buckets):
+                le = "+Inf" if b == float("inf") else b
+                lines.append(f'{self.name}_bucket{{{lab},le="{le}"}} {c}')
+            lines.append(f"{self.name}_sum{{{lab}}} {total}")
+            lines.append(f"{self.name}_count{{{lab}}} {counts[-1]}")
+        return "\n".join(lines)
+
+
+class Tracer:
+    """Record spans (LLM calls, tool calls, BigTask plan, steps and
+    validations) with their duration, tokens, cost and error. Finished
+    spans are appended to jsonl_path and the latency histograms and
+    counters are written to prom_path, in prometheus text format, each
+    time a whole question is answered. The spans are reported by the
+    callback handler of trace_handler."""
+
+    def __init__(self, jsonl_path, prom_path):
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.histograms = {
+                "llm": Histogram("llm_agent_llm_duration_seconds", "model", "Duration of the LLM calls"),
+                "tool": Histogram("llm_agent_tool_duration_seconds", "tool", "Duration of the tool calls"),
+                "span": Histogram("llm_agent_span_duration_seconds", "kind", "Duration of the agent runs, BigTask plans, steps and validations"),
+                "role": Histogram("llm_agent_role_duration_seconds", "role", "Duration of the LLM calls by role, see the routes option"),
+                }
+        self.counters = {}
+
+    def start(self, run_id, parent_id, kind, name, role=None):
+        with self.lock:
+            parent = self.spans.get(parent_id)
+            if role is None and parent is not None:
+                role = parent.get("role")
+            self.spans[run_id] = {
+                    "parent_run_id": parent_id if parent else None,
+                    "trace_id": parent["trace_id"] if parent else str(run_id),
+                    "span_id": str(run_id),
+                    "parent_id": str(parent_id) if parent else None,
+                    "kind": kind,
+                    "name": name,
+                    "start": time.time(),
+                    "perf": time.perf_counter(),
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "cost": 0.0,
+                    "error": None,
+                    }
+            if role is not None:
+                self.spans[run_id]["role"] = role
+
+    def kind(self, run_id):
+        span = self.spans.get(run_id)
+        return span and span["kind"]
+
+    def end(self, run_id, error=None, prompt_tokens=0, completion_tokens=0, cost=0.0, model=None):
+        with self.lock:
+            span = self.spans.pop(run_id, None)
+            if span is None:
+                return
+            parent = self.spans.get(span.pop("parent_run_id"))
+            span["duration"] = time.perf_counter() - span.pop("perf")
+            span["error"] = str(error) if error is not None else None
+            if model:
+                span["name"] = model
+            span["prompt_tokens"] += prompt_tokens
+            span["completion_tokens"] += completion_tokens
+            span["cost"] += cost
+
+            # the tokens and cost of a span include those of its children
+            if parent is not None:
+                parent["prompt_tokens"] += span["prompt_tokens"]
+                parent["completion_tokens"] += span["completion_tokens"]
+                parent["cost"] += span["cost"]
+
+            kind, name = span["kind"], span["name"]
+            if kind in ("llm", "tool"):
+                self.histograms[kind].observe(span["duration"], name)
+            elif kind != "chain":
+                self.histograms["span"].observe(span["duration"], kind)
+            if kind == "llm":
+                self.count("llm_agent_llm_tokens_total", f'model="{name}",type="prompt"', prompt_tokens)
+                self.count("llm_agent_llm_tokens_total", f'model="{name}",type="completion"', completion_tokens)
+                self.count("llm_agent_llm_cost_dollars_total", f'model="{name}"', cost)
+            if kind == "llm" and "role" in span:
+                self.histograms["role"].observe(span["duration"], span["role"])
+                self.count("llm_agent_role_cost_dollars_total", f'role="{span["role"]}"', cost)
+            if error is not None:
+                self.count("llm_agent_errors_total", f'kind="{kind}",name="{name}"', 1)
+
+            with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(span) + "\n")
+            if span["parent_id"] is None:
+                self.write_prometheus()
+
+    def count(self, name, labels, value):
+        self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def write_prometheus(self):
+        "the file is replaced atomically, e.g. for node_exporter's textfile collector"
+        lines = [h.text() for h in self.histograms.values() if h.series]
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (n, labels), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append(f"{name}{{{labels}}} {value}")
+        tmp = f"{self.prom_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.prom_path)
+
+
+def trace_handler(tracer):
+    "Create a langchain callback handler reporting the runs to a Tracer"
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    class TraceHandler(BaseCallbackHandler):
+        def __init__(self):
+            # runs that are not traced, mapped to their parent
+            self.skipped = {}
+            self.bigtask_runs = set()
+
+        def parent(self, parent_run_id):
+            while parent_run_id in self.skipped:
+                parent_run_id = self.skipped[parent_run_id]
+            return parent_run_id
+
+        def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, **kwargs):
+            parent_run_id = self.parent(parent_run_id)
+            name = (serialized or {}).get("id", ["chain"])[-1]
+            if "planner" in (tags or []):
+                kind = "planner"
+            elif "validation" in (tags or []):
+                kind = "validation"
+            elif tracer.kind(parent_run_id) is None:
+                kind = "agent"
+            elif parent_run_id in self.bigtask_runs:
+                kind = "step"
+            else:
+                kind = "chain"
+            tracer.start(run_id, parent_run_id, kind, name, role=tag_role(tags))
+
+        def on_chain_end(self, outputs, *, run_id, **kwargs):
+            tracer.end(run_id)
+
+        def on_chain_error(self, error, *, run_id, **kwargs):
+            tracer.end(run_id, error=error)
+
+        def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, tags=None, **kwargs):
+            model = (serialized or {}).get("kwargs", {}).get("model_name", "llm")
+            tracer.start(run_id, self.parent(parent_run_id), "llm", model, role=tag_role(tags))
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, tags=None, **kwargs):
+            self.on_llm_start(serialized, None, run_id=run_id, parent_run_id=parent_run_id, tags=tags)
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            model, prompt_tokens, completion_tokens, cost = llm_usage(response)
+            tracer.end(run_id, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, cost=cost, model=model)
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            tracer.end(run_id, error=error)
+
+        def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs):
+            parent_run_id = self.parent(parent_run_id)
+            # the cached and lazily loaded tools call the real tool inside
+            # a proxy of the same name
+            if tracer.kind(parent_run_id) == "tool":
+                self.skipped[run_id] = parent_run_id
+                return
+            name = (serialized or {}).get("name", "tool")
+            if name == "BigTask":
+                self.bigtask_runs.add(run_id)
+            tracer.start(run_id, parent_run_id, "tool", name)
+
+        def on_tool_end(self, output, *, run_id, **kwargs):
+            self.bigtask_runs.discard(run_id)
+            if self.skipped.pop(run_id, None) is None:
+                tracer.end(run_id)
+
+        def on_tool_error(self, error, *, run_id, **kwargs):
+            self.bigtask_runs.discard(run_id)
+            if self.skipped.pop(run_id, None) is None:
+                tracer.end(run_id, error=error)
+
+    return TraceHandler()
+
+
+class SQLiteLRU:
+    """Small key/value store in a SQLite table that can be shared by
+    several threads and processes. The least recently used entries are
+    evicted when there are more than max_entries."""
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+        with self.lock, self.db:
+            # WAL allows several llm processes to use the cache at once
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS cache ("
+                    "namespace TEXT, key TEXT, value TEXT, created REAL, accessed REAL, "
+                    "PRIMARY KEY (namespace, key))")
+            self.db.execute(
+                    "CREATE INDEX IF NOT EXISTS cache_accessed "
+                    "ON cache (accessed)")
+
+    def get(self, namespace, key, ttl=None):
+        "returns the cached value or None if missing or older than ttl seconds"
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute(
+                    "SELECT value, created FROM cache WHERE namespace = ? AND key = ?",
+                    (namespace, key)).fetchone()
+            if row is not None and ttl is not None and now - row[1] > ttl:
+                self.db.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.db.execute(
+                    "UPDATE cache SET accessed = ? WHERE namespace = ? AND key = ?",
+                    (now, namespace, key))
+            self.hits += 1
+            return row[0]
+
+    def set(self, namespace, key, value):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                    (namespace, key, value, now, now))
+            count = self.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            if count > self.max_entries:
+                # evict a bit more than needed to not do it on each call
+                self.db.execute(
+                        "DELETE FROM cache WHERE rowid IN ("
+                        "SELECT rowid FROM cache ORDER BY accessed LIMIT ?)",
+                        (count - self.max_entries + self.max_entries // 10,))
+
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM cache")
+
+
+class ToolCache(SQLiteLRU):
+    """Disk backed cache of tool results, shared across sessions.
+    Entries expire after the TTL of their tool and the least recently
+    used ones are evicted when there are more than max_entries."""
+
+    def __init__(self, path, ttls=TOOL_CACHE_TTL, max_entries=DEFAULT_TOOL_CACHE_SIZE):
+        super().__init__(path, max_entries)
+        self.ttls = ttls
+
+    @staticmethod
+    def normalize(tool_input):
+        "cache key, identical for queries differing only in case, spacing or trailing punctuation"
+        if isinstance(tool_input, dict):
+            if len(tool_input) == 1:
+                tool_input = list(tool_input.values())[0]
+            else:
+                tool_input = json.dumps(tool_input, sort_keys=True)
+        key = " ".join(str(tool_input).lower().split())
+        return key.strip(" \"'`?!.,;:")
+
+    def get(self, tool, tool_input):
+        "returns the cached result or None"
+        return super().get(tool, self.normalize(tool_input), self.ttls[tool])
+
+    def set(self, tool, tool_input, value):
+        super().set(tool, self.normalize(tool_input), value)
+
+    @property
+    def stats(self):
+        return f"Tool cache: {self.hits} hits, {self.misses} misses"
+
+    def wrap(self, tool):
+        "returns tool with a cache in front of it if its results can be cached"
+        if tool.name not in self.ttls:
+            return tool
+
+        def run(tool_input, callbacks):
+            cached = self.get(tool.name, tool_input)
+            if cached is not None:
+                return cached
+            output = tool.run(tool_input, callbacks=callbacks)
+            if not isinstance(output, ToolFailure):
+                self.set(tool.name, tool_input, str(output))
+            return output
+
+        async def arun(tool_input, callbacks):
+            cached = await asyncio.to_thread(self.get, tool.name, tool_input)
+            if cached is not None:
+                return cached
+            output = await arun_tool(tool, tool_input, callbacks)
+            if not isinstance(output, ToolFailure):
+                await asyncio.to_thread(self.set, tool.name, tool_input, str(output))
+            return output
+
+        return wrap_tool(tool, run, arun)
+
+
+class LLMCache(SQLiteLRU):
+    """Exact match cache of the LLM completions, implementing langchain's
+    BaseCache interface (see set_llm_cache). Langchain keys it with the
+    serialized messages and the model parameters, including the model
+    name and temperature."""
+
+    def lookup(self, prompt, llm_string):
+        from langchain.load.load import loads
+        value = self.get(llm_string, prompt)
+        if value is None:
+            return None
+        return [loads(gen) for gen in json.loads(value)]
+
+    def update(self, prompt, llm_string, return_val):
+        from langchain.load.dump import dumps
+        self.set(llm_string, prompt, json.dumps([dumps(gen) for gen in return_val]))
+
+    @property
+    def stats(self):
+        return f"LLM cache: {self.hits} hits, {self.misses} misses"
+
+
+class Cassette:
+    """Record the LLM requests and tool calls of the agent, with their
+    response and latency, in a JSONL file, or serve them back from it
+    without calling the LLM or the tools. Requests are matched by a hash
+    of their content, identical requests getting the responses in the
+    recorded order, so the parallel steps of BigTask can be replayed in
+    any order. The dates of the pinned messages, like today's date in the
+    preamble, are left out of the hash so that a cassette can be replayed
+    on another day. In mode 'auto' the cassette is replayed if it exists,
+    recorded otherwise. 'replay_timed' waits the recorded latencies."""
+    modes = ("auto", "record", "replay", "replay_timed")
+    date_re = re.compile(r"\b\d{4}-\d{2}-\d{2}\b")
+
+    def __init__(self, path, mode="auto"):
+        if mode == "auto":
+            mode = "replay" if os.path.exists(path) else "record"
+        self.path = path
+        self.mode = mode
+        self.replaying = mode.startswith("replay")
+        self.timed = mode == "replay_timed"
+        self.lock = threading.Lock()
+        self.entries = {}
+        if self.replaying:
+            for entry in read_jsonl(path):
+                self.entries.setdefault(entry["key"], []).append(entry)
+        else:
+            open(path, "w").close()
+
+    @staticmethod
+    def key(kind, name, request):
+        request = json.dumps([kind, name, request], sort_keys=True, default=str)
+        return hashlib.sha256(request.encode()).hexdigest()[:32]
+
+    def record(self, key, kind, name, response, latency):
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            entry = {"key": key, "kind": kind, "name": name, "latency": round(latency, 4), "response": response}
+            f.write(json.dumps(entry) + "\n")
+
+    def replay(self, key, kind, name):
+        "returns the recorded response and latency"
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                raise Exception(f"No {kind} call to {name} matching the request in cassette {self.path}")
+            # the last response is kept for any further identical request
+            entry = entries.pop(0) if len(entries) > 1 else entries[0]
+        return entry["response"], entry["latency"] if self.timed else 0
+
+    def wrap(self, tool):
+        "returns tool recorded to, or replayed from, the cassette"
+
+        def run(tool_input, callbacks):
+            key = self.key("tool", tool.name, tool_input)
+            if self.replaying:
+                output, latency = self.replay(key, "tool", tool.name)
+                time.sleep(latency)
+                return output
+            t = time.perf_counter()
+            output = tool.run(tool_input, callbacks=callbacks)
+            self.record(key, "tool", tool.name, str(output), time.perf_counter() - t)
+            return output
+
+        async def arun(tool_input, callbacks):
+            key = self.key("tool", tool.name, tool_input)
+            if self.replaying:
+                output, latency = self.replay(key, "tool", tool.name)
+                await asyncio.sleep(latency)
+                return output
+            t = time.perf_counter()
+            output = await arun_tool(tool, tool_input, callbacks)
+            self.record(key, "tool", tool.name, str(output), time.perf_counter() - t)
+            return output
+
+        return wrap_tool(tool, run, arun)
+
+    def wrap_llm(self, llm):
+        "returns a chat model recording the requests of llm or replaying them"
+        return cassette_chat_model_class()(inner=llm, cassette=self, cache=False, streaming=llm.streaming)
+
+
+@functools.lru_cache(maxsize=None)
+def cassette_chat_model_class():
+    from typing import Any
+    from langchain.chat_models.base import BaseChatModel
+    from langchain.schema import AIMessage, ChatGeneration, ChatResult
+
+    class CassetteChatModel(BaseChatModel):
+        """Chat model calling inner and recording its answers to the
+        cassette, or only replaying them. The LLM cache is bypassed so
+        that every request is recorded."""
+        inner: Any
+        cassette: Any
+        streaming: bool = False
+
+        @property
+        def _llm_type(self):
+            return "cassette"
+
+        def request(self, messages, stop):
+            key = self.cassette.key("llm", getattr(self.inner, "model_name", None), [
+                [m.type, self.normalize(m), m.additional_kwargs] for m in messages] + [stop])
+            return key, getattr(self.inner, "model_name", "llm")
+
+        def normalize(self, message):
+            "content of message, without the dates if it's pinned"
+            if not message.additional_kwargs.get("pinned"):
+                return message.content
+            return self.cassette.date_re.sub("<date>", str(message.content))
+
+        @staticmethod
+        def dump(result):
+            return {
+                    "generations": [[g.message.content, g.message.additional_kwargs] for g in result.generations],
+                    "llm_output": result.llm_output,
+                    }
+
+        @staticmethod
+        def load(response):
+            return ChatResult(
+                    generations=[
+                        ChatGeneration(message=AIMessage(content=content, additional_kwargs=kwargs))
+                        for content, kwargs in response["generations"]],
+                    llm_output=response["llm_output"],
+                    )
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            key, name = self.request(messages, stop)
+            if self.cassette.replaying:
+                response, latency = self.cassette.replay(key, "llm", name)
+                time.sleep(latency)
+                result = self.load(response)
+                if self.streaming and run_manager:
+                    run_manager.on_llm_new_token(result.generations[0].message.content)
+                return result
+            t = time.perf_counter()
+            result = self.inner._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            self.cassette.record(key, "llm", name, self.dump(result), time.perf_counter() - t)
+            return result
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            key, name = self.request(messages, stop)
+            if self.cassette.replaying:
+                response, latency = self.cassette.replay(key, "llm", name)
+                await asyncio.sleep(latency)
+                result = self.load(response)
+                if self.streaming and run_manager:
+                    await run_manager.on_llm_new_token(result.generations[0].message.content)
+                return result
+            t = time.perf_counter()
+            result = await self.inner._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            self.cassette.record(key, "llm", name, self.dump(result), time.perf_counter() - t)
+            return result
+
+    return CassetteChatModel
+
+
+@functools.lru_cache(maxsize=None)
+def streaming_chat_model_class():
+    from langchain.chat_models import ChatOpenAI
+
+    class StreamingChatOpenAI(ChatOpenAI):
+        """ChatOpenAI whose streamed answers report their token usage, that
+        openai doesn't give when streaming, so that the budgets, costs and
+        stats keep counting them. The tokens are counted with tiktoken,
+        or estimated with approx_tokens if it's not installed."""
+
+        def count(self, messages, result):
+            if (result.llm_output or {}).get("token_usage"):
+                return result
+            try:
+                prompt_tokens = self.get_num_tokens_from_messages(messages)
+                completion_tokens = sum(self.get_num_tokens(g.text) for g in result.generations)
+            except Exception:
+                prompt_tokens = sum(approx_tokens(str(m.content)) for m in messages)
+                completion_tokens = sum(approx_tokens(g.text) for g in result.generations)
+            result.llm_output = {
+                    "token_usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                        },
+                    "model_name": self.model_name,
+                    }
+            return result
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            return self.count(messages, super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            return self.count(messages, await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    return StreamingChatOpenAI
+
+
+@functools.lru_cache(maxsize=None)
+def fallback_chat_model_class():
+    from typing import Any
+    from langchain.chat_models.base import BaseChatModel
+
+    class FallbackChatModel(BaseChatModel):
+        """Chat model calling primary or, if it times out, is rate limited
+        or unavailable, fallback. After the threshold of consecutive
+        failures of breaker, primary is not called at all until its
+        cooldown is over."""
+        primary: Any
+        fallback: Any
+        breaker: Any
+        streaming: bool = False
+
+        @property
+        def _llm_type(self):
+            return "fallback"
+
+        @property
+        def model_name(self):
+            return self.primary.model_name
+
+        @property
+        def _identifying_params(self):
+            # the completions are cached as those of primary
+            return {**self.primary._identifying_params, "fallback": self.fallback.model_name}
+
+        def failed(self, err):
+            if isinstance(err, BudgetExceeded) or not is_transient(err):
+                raise err
+            self.breaker.failure()
+            print(f"Error {err} from {self.primary.model_name}, falling back to {self.fallback.model_name}")
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            if self.breaker.available():
+                try:
+                    result = self.primary._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                except Exception as err:
+                    self.failed(err)
+                else:
+                    self.breaker.success()
+                    return result
+            return self.fallback._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            if self.breaker.available():
+                try:
+                    result = await self.primary._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                except Exception as err:
+                    self.failed(err)
+                else:
+                    self.breaker.success()
+                    return result
+            return await self.fallback._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    return FallbackChatModel
+
+
+class MemoryStore:
+    """Persistent memories of the users in a SQLite database. Adding a
+    memory is a single insert instead of rewriting every memory and
+    several llm processes can safely use it at the same time."""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS memories ("
+                    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "user TEXT NOT NULL, timestamp INTEGER NOT NULL, message TEXT NOT NULL)")
+            self.db.execute(
+                    "CREATE INDEX IF NOT EXISTS memories_user_timestamp "
+                    "ON memories (user, timestamp)")
+
+    def add(self, user, message, timestamp=None):
+        assert message, "Empty message in memory"
+        if timestamp is None:
+            timestamp = int(time.time())
+        with self.lock, self.db:
+            return self.db.execute(
+                    "INSERT INTO memories (user, timestamp, message) VALUES (?, ?, ?)",
+                    (user, timestamp, message)).lastrowid
+
+    def get(self, user, start=None, end=None):
+        """memories of the user as a list of dict, oldest first, optionally
+        only those with start <= timestamp < end"""
+        query = "SELECT id, timestamp, message FROM memories WHERE user = ?"
+        args = [user]
+        if start is not None:
+            query += " AND timestamp >= ?"
+            args.append(start)
+        if end is not None:
+            query += " AND timestamp < ?"
+            args.append(end)
+        with self.lock:
+            rows = self.db.execute(query + " ORDER BY timestamp, id", args).fetchall()
+        return [{"id": i, "timestamp": t, "message": m} for i, t, m in rows]
+
+    def compact(self, user=None):
+        """remove the duplicated memories (keeping the oldest one) and
+        reclaim the disk space. Returns the number of deleted memories."""
+        query = (
+                "DELETE FROM memories WHERE id NOT IN ("
+                "SELECT MIN(id) FROM memories GROUP BY user, message)")
+        args = []
+        if user is not None:
+            query += " AND user = ?"
+            args.append(user)
+        with self.lock:
+            with self.db:
+                deleted = self.db.execute(query, args).rowcount
+            self.db.execute("VACUUM")
+        return deleted
+
+    def migrate_json(self, user, path):
+        """import the memories of the json file used by older versions
+        then rename it so that it's only done once"""
+        with open(path, "r") as file:
+            memories = json.load(file)
+        assert isinstance(memories, list), "Memories is not a list"
+        for mem in memories:
+            assert isinstance(mem, dict), "Invalid type of memory"
+            assert "timestamp" in mem, "Memory missing timestamp key"
+            assert "message" in mem, "Memory missing message key"
+            assert mem["message"], "Empty message in memory"
+        with self.lock, self.db:
+            self.db.executemany(
+                    "INSERT INTO memories (user, timestamp, message) VALUES (?, ?, ?)",
+                    [(user, int(mem["timestamp"]), mem["message"]) for mem in memories])
+        path.rename(path.with_suffix(".json.migrated"))
+        return len(memories)
+
+
+def approx_tokens(text):
+    "rough number of tokens of text, good enough for budgeting"
+    return len(text) // 4 + 1
+
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+
+class BM25Index:
+    """Minimal offline BM25 index, used to only give the LLM the memories
+    that are relevant to the question. The memories are added by the
+    memorize tool while other questions search them."""
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()
+        self.texts = []
+        self.lengths = []
+        self.total_length = 0
+        self.total_tokens = 0  # see approx_tokens
+        self.postings = {}  # term -> {index of text: term frequency}
+
+    def add(self, text):
+        terms = tokenize(text)
+        with self.lock:
+            i = len(self.texts)
+            self.texts.append(text)
+            self.lengths.append(len(terms))
+            self.total_length += len(terms)
+            self.total_tokens += approx_tokens(text)
+            for term in terms:
+                freqs = self.postings.setdefault(term, {})
+                freqs[i] = freqs.get(i, 0) + 1
+
+    def search(self, query, k=None):
+        "returns the (score, index) of the k best matching texts"
+        terms = set(tokenize(query))
+        scores = {}
+        with self.lock:
+            n = len(self.texts)
+            if not n:
+                return []
+            avg_length = self.total_length / n
+            for term in terms:
+                freqs = self.postings.get(term)
+                if not freqs:
+                    continue
+                idf = math.log(1 + (n - len(freqs) + 0.5) / (len(freqs) + 0.5))
+                for i, freq in freqs.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / avg_length)
+                    scores[i] = scores.get(i, 0) + idf * freq * (self.k1 + 1) / (freq + norm)
+        if k is None:
+            return sorted(((score, i) for i, score in scores.items()), reverse=True)
+        return heapq.nlargest(k, ((score, i) for i, score in scores.items()))
+
+
+def select_memories(index, question, k, max_tokens):
+    """The memories to give to the LLM for this question: all of them if
+    they fit in max_tokens, otherwise the k most relevant that fit."""
+    if index.total_tokens <= max_tokens:
+        return list(index.texts)
+    selected = []
+    for score, i in index.search(question, k):
+        text = index.texts[i]
+        if approx_tokens(text) > max_tokens:
+            continue
+        max_tokens -= approx_tokens(text)
+        selected.append(text)
+    return selected
+
+
+class ToolSelector:
+    """Picks the tools given to BigTask's agent for a step: the k tools
+    whose name and description best match the step, with BM25, plus
+    those of ALWAYS_SELECTED_TOOLS. The tools of a group (e.g. the browser
+    tools) are picked together and count as one. If too few tools match,
+    the first ones are added."""
+
+    def __init__(self, tools, k, groups=None):
+        self.k = k
+        # lists of tools picked together, in the order of tools
+        self.units = []
+        positions = {}
+        for tool in tools:
+            group = (groups or {}).get(tool.name, tool.name)
+            if group not in positions:
+                positions[group] = len(self.units)
+                self.units.append([])
+            self.units[positions[group]].append(tool)
+        self.index = BM25Index()
+        for unit in self.units:
+            self.index.add(self.normalize(" ".join(
+                f"{t.name.replace('_', ' ')} {t.description} {TOOL_KEYWORDS.get(t.name, '')}" for t in unit)))
+        self.always = {i for i, unit in enumerate(self.units) if any(t.name in ALWAYS_SELECTED_TOOLS for t in unit)}
+
+    @staticmethod
+    def normalize(text):
+        # crude stemming, to match 'papers' with 'paper'
+        return " ".join(term[:-1] if len(term) > 3 and term.endswith("s") else term for term in tokenize(text))
+
+    def select(self, text):
+        """the tools for text, in their original order so that the same
+        selection reuses the same agent"""
+        # the words found in most tools, like 'search', don't tell them apart
+        query = [
+                term for term in self.normalize(text).split()
+                if term not in STOPWORDS and len(self.index.postings.get(term, ())) <= len(self.units) / 2]
+        selected = set(self.always)
+        ranked = [i for _, i in self.index.search(" ".join(query))] + list(range(len(self.units)))
+        for i in ranked:
+            if len(selected) >= self.k + len(self.always):
+                break
+            selected.add(i)
+        return [t for i in sorted(selected) for t in self.units[i]]
+
+
+@functools.lru_cache(maxsize=None)
+def token_budget_memory_class():
+    """Returns the TokenBudgetMemory class, created on demand as it
+    depends on langchain."""
+    from langchain.memory import ConversationBufferMemory
+    from langchain.memory.prompt import SUMMARY_PROMPT
+    from langchain.pydantic_v1 import PrivateAttr
+    from langchain.schema import SystemMessage, get_buffer_string
+    from langchain.schema.language_model import BaseLanguageModel
+
+    class TokenBudgetMemory(ConversationBufferMemory):
+        """Conversation memory that never gives more than max_tokens to
+        the LLM. The older messages are folded into a running summary by a
+        background thread so that summarizing never delays an answer,
+        messages that don't fit in the budget before the summary caught up
+        with them are left out. Messages whose additional_kwargs contain
+        'pinned' (the date, the user memories...) are always kept.
+        Several instances can share the same chat_memory with their own
+        budget."""
+        llm: BaseLanguageModel
+        max_tokens: int
+        summary: str = ""
+        summarized: int = 0  # number of unpinned messages in the summary
+        _lock = PrivateAttr(default_factory=threading.Lock)
+        _summarizing = PrivateAttr(default=False)
+
+        def unpinned(self):
+            return [m for m in self.chat_memory.messages if not m.additional_kwargs.get("pinned")]
+
+        def load_memory_variables(self, inputs):
+            with self._lock:
+                summary, summarized = self.summary, self.summarized
+            messages = [m for m in self.chat_memory.messages if m.additional_kwargs.get("pinned")]
+            if summary:
+                messages.append(SystemMessage(content=f"Summary of the earlier conversation:\n{summary}"))
+            budget = self.max_tokens - sum(approx_tokens(m.content) for m in messages)
+
+            recent = []
+            for message in reversed(self.unpinned()[summarized:]):
+                budget -= approx_tokens(message.content)
+                if budget < 0 and recent:
+                    break
+                recent.insert(0, message)
+            return {self.memory_key: messages + recent}
+
+        def save_context(self, inputs, outputs):
+            super().save_context(inputs, outputs)
+            self.summarize()
+
+        def summarize(self):
+            """Fold the oldest messages into the summary in a thread when
+            the messages not yet summarized exceed 3/4 of the budget,
+            keeping about 1/4 of the budget of recent messages as is."""
+            messages = self.unpinned()
+            with self._lock:
+                if self._summarizing:
+                    return
+                start = self.summarized
+                if sum(approx_tokens(m.content) for m in messages[start:]) <= self.max_tokens * 3 // 4:
+                    return
+                end = len(messages)
+                kept = 0
+                while end > start + 1 and kept + approx_tokens(messages[end - 1].content) <= self.max_tokens // 4:
+                    end -= 1
+                    kept += approx_tokens(messages[end].content)
+                self._summarizing = True
+                summary = self.summary
+
+            def run():
+                try:
+                    new_summary = self.llm.predict(SUMMARY_PROMPT.format(
+                        summary=summary,
+                        new_lines=get_buffer_string(messages[start:end])))
+                    with self._lock:
+                        self.summary = new_summary.strip()
+                        self.summarized = end
+                except Exception as err:
+                    print(f"Error when summarizing the conversation: '{err}'")
+                finally:
+                    with self._lock:
+                        self._summarizing = False
+
+            thread = threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True)
+            thread.start()
+
+        def clear(self):
+            super().clear()
+            with self._lock:
+                self.summary = ""
+                self.summarized = 0
+
+    return TokenBudgetMemory
+
+
+class LazyToolRegistry:
+    """Tools are declared up front by name and description but their
+    modules are only imported and the tool instantiated the first time
+    the agent actually calls them."""
+
+    def __init__(self, verbose=True):
+        self.verbose = verbose
+        self.declared = {}
+        self.loaded = {}
+        self.failed = {}  # name -> error of the loader, not retried
+        self.locks = {}
+
+    def declare(self, name, description, loader, args_schema=None):
+        """loader is a callable taking no argument and returning the
+        real langchain tool. If args_schema is None the tool is assumed
+        to take a single 'query' string."""
+        self.declared[name] = (description, loader, args_schema)
+        self.locks[name] = threading.Lock()
+
+    def load(self, name):
+        "import and instantiate the tool if needed"
+        if name not in self.loaded:
+            with self.locks[name]:
+                if name in self.failed:
+                    raise self.failed[name]
+                if name not in self.loaded:
+                    t = time.time()
+                    try:
+                        self.loaded[name] = self.declared[name][1]()
+                    except Exception as err:
+                        print(f"Error when loading tool {name}: {str(err).splitlines()[0]}")
+                        self.failed[name] = err
+                        raise
+                    if self.verbose:
+                        print(f"(Loaded tool {name} in {time.time() - t:.2f}s)")
+        return self.loaded[name]
+
+    def unavailable(self, name, err):
+        # an observation rather than an exception, that would stop the agent
+        return ToolFailure(f"The tool {name} is not available ({str(err).splitlines()[0]}), use another tool.")
+
+    def get_tool(self, name):
+        """returns a langchain tool that loads the real one on first call,
+        or says that it is not available if it can't be loaded"""
+        description, _, args_schema = self.declared[name]
+
+        def run(tool_input, callbacks):
+            try:
+                tool = self.load(name)
+            except Exception as err:
+                return self.unavailable(name, err)
+            return tool.run(tool_input, callbacks=callbacks)
+
+        async def arun(tool_input, callbacks):
+            try:
+                tool = await asyncio.to_thread(self.load, name)
+            except Exception as err:
+                return self.unavailable(name, err)
+            return await arun_tool(tool, tool_input, callbacks)
+
+        return wrap_tool(None, run, arun, name=name, description=description, args_schema=args_schema)
+
+    def get_tools(self):
+        return [self.get_tool(name) for name in self.declared]
+
+
+def parse_plan(text):
+    """Parse the output of the BigTask planner into a list of
+    (step, dependencies) where dependencies is the set of the indexes
+    of the earlier steps that have to be done first.
+    Steps are expected as 'N. step | needs: 1, 3' or 'N. step | needs: none'.
+    Lines that don't say what they need (for example if the LLM ignored
+    the format) are assumed to depend on the previous step."""
+    plan = []
+    numbers = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("```"):
+            continue
+        match = re.match(r"^(\d+)[.)]\s*(.*)$", line)
+        if match:
+            numbers[match.group(1)] = len(plan)
+            line = match.group(2)
+
+        if "|" in line and re.search(r"needs?\s*:", line.split("|")[-1], re.IGNORECASE):
+            needs = line.split("|")[-1].split(":", 1)[1]
+            step = "|".join(line.split("|")[:-1]).strip()
+            deps = set(
+                    numbers[n] for n in re.findall(r"\d+", needs)
+                    # only earlier steps, this keeps the plan acyclic
+                    if n in numbers and numbers[n] < len(plan)
+                    )
+        else:
+            step = line
+            deps = {len(plan) - 1} if plan else set()
+        plan.append((step, deps))
+    return plan
+
+
+def plan_ancestors(plan, i):
+    "indexes of all the steps that step i needs, directly or not"
+    ancestors = set()
+    todo = list(plan[i][1])
+    while todo:
+        j = todo.pop()
+        if j not in ancestors:
+            ancestors.add(j)
+            todo.extend(plan[j][1])
+    return ancestors
+
+
+def plan_prompt(question, plan, answers, current=None):
+    """Create the prompt given to the sub_agent for step 'current' or,
+    if current is None, for the final answer. Only the answers of the
+    steps that the current step depends on are shown."""
+    visible = set(answers) if current is None else plan_ancestors(plan, current)
+    prompt = f"The end goal it to answer this: '{question}'.\n\n"
+    prompt += "Here is the task planning:"
+    for i, (step, deps) in enumerate(plan):
+        if i == current:
+            status = "TODO"
+        elif i in visible and i in answers:
+            status = f"Done: '{answers[i]}'"
+        elif i in answers:
+            status = "Handled separately"
+        else:
+            status = "LATER"
+        prompt += f"\n{i+1}. {step}. {status}"
+    if current is None:
+        prompt += "\n\nNow please answer the initial question."
+    else:
+        prompt += f"\n\nYour current task is #{current+1}"
+    return prompt.strip()
+
+
+class PlanState:
+    """Bookkeeping of the execution of a plan, shared by run_plan and
+    arun_plan. A step is started as soon as all the steps it depends on
+    have an answer. If validate is True, each answer is also checked in
+    the background while the steps that need it already run with it: if
+    the check corrects the answer, only the steps that depend on it are
+    run again.
+    The answers are saved to checkpoint, a Checkpoint, whose finished
+    steps are not run again."""
+
+    def __init__(self, plan, validate=False, progress=None, checkpoint=None):
+        self.plan = plan
+        self.validate = validate
+        self.progress = progress
+        self.results = {}
+        self.answers = {}
+        self.inputs = {}  # answers given to the run of each step
+        self.versions = [0] * len(plan)  # incremented each time an answer is set
+        self.ancestors = [plan_ancestors(plan, i) for i in range(len(plan))]
+        self.started = {}  # step -> versions of the answers its run got
+        self.checking = {}  # step -> version of its answer being checked
+        self.checked = set()
+        self.checkpoint = None
+        if checkpoint is not None:
+            for i, answerdict in checkpoint.results.items():
+                self.set(i, answerdict, {j: checkpoint.results[j]["output"] for j in self.ancestors[i] if j in checkpoint.results})
+            self.checked.update(checkpoint.checked)
+            if progress is not None:
+                progress.update(len(self.results))
+        self.checkpoint = checkpoint
+
+    def finished(self):
+        return len(self.results) == len(self.plan) and (not self.validate or len(self.checked) == len(self.plan))
+
+    def jobs(self):
+        """the new jobs to start, ('step', i, answers, versions) to run
+        step i and ('check', i, answers, version) to validate its answer"""
+        jobs = []
+        for i, (step, deps) in enumerate(self.plan):
+            if i in self.results or i in self.started or not deps.issubset(self.answers):
+                continue
+            self.started[i] = {j: self.versions[j] for j in self.ancestors[i]}
+            jobs.append(("step", i, dict(self.answers), self.started[i]))
+        if self.validate:
+            for i in self.results:
+                if i not in self.checked and self.checking.get(i) != self.versions[i]:
+                    self.checking[i] = self.versions[i]
+                    jobs.append(("check", i, self.inputs[i], self.versions[i]))
+        return jobs
+
+    def done(self, job, answerdict):
+        kind, i, answers, version = job
+        if kind == "step":
+            if self.started.get(i) is version:
+                del self.started[i]
+            # ignore the runs that used answers corrected since then
+            if any(self.versions[j] != v for j, v in version.items()):
+                return
+            self.set(i, answerdict, answers)
+            if self.progress is not None:
+                self.progress.update(1)
+        elif self.versions[i] == version:
+            if answerdict is not self.results[i]:
+                self.set(i, answerdict, answers)
+                for j in range(len(self.plan)):
+                    if i in self.ancestors[j]:
+                        self.invalidate(j)
+            self.checked.add(i)
+            if self.checkpoint is not None:
+                self.checkpoint.check(i)
+
+    def set(self, i, answerdict, answers):
+        self.results[i] = answerdict
+        self.answers[i] = answerdict["output"]
+        self.inputs[i] = answers
+        self.versions[i] += 1
+        self.checked.discard(i)
+        if self.checkpoint is not None:
+            self.checkpoint.set(i, answerdict)
+
+    def invalidate(self, i):
+        "forget the answer of step i so that it is run again"
+        self.started.pop(i, None)
+        self.checked.discard(i)
+        # the runs and checks in progress are now outdated
+        self.versions[i] += 1
+        if i in self.results:
+            del self.results[i]
+            del self.answers[i]
+            if self.progress is not None:
+                self.progress.update(-1)
+            if self.checkpoint is not None:
+                self.checkpoint.invalidate(i)
+
+
+class Checkpoint:
+    """Plan of a BigTask and the answers of its steps, appended to a
+    JSONL file as soon as they are known so that an interrupted BigTask
+    can be resumed. load() sets plan (None if there is no checkpoint),
+    the results of the finished steps and the steps already validated."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        self.plan = None
+        self.results = {}
+        self.checked = set()
+        if not self.path.exists():
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line cut by a crash
+                    continue
+                if "plan" in record:
+                    self.plan = [(step, set(deps)) for step, deps in record["plan"]]
+                    continue
+                i = record["step"]
+                self.checked.discard(i)
+                if "output" in record:
+                    self.results[i] = {
+                            "output": record["output"],
+                            "intermediate_steps": [tuple(s) for s in record["intermediate_steps"]],
+                            }
+                elif record.get("invalidated"):
+                    self.results.pop(i, None)
+                elif record.get("checked"):
+                    self.checked.add(i)
+
+    def start(self, plan):
+        "start a new checkpoint for plan"
+        with self.lock:
+            self.plan, self.results, self.checked = plan, {}, set()
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"plan": [(step, sorted(deps)) for step, deps in plan]}) + "\n")
+
+    def _append(self, record):
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def set(self, i, answerdict):
+        # the steps stopped by their budget will be done again
+        if answerdict.get("unfinished"):
+            return
+        self._append({
+            "step": i,
+            "output": answerdict["output"],
+            "intermediate_steps": [(str(action), str(observation)) for action, observation in answerdict["intermediate_steps"]],
+            })
+
+    def invalidate(self, i):
+        self._append({"step": i, "invalidated": True})
+
+    def check(self, i):
+        self._append({"step": i, "checked": True})
+
+    def remove(self):
+        with self.lock:
+            if self.path.exists():
+                self.path.unlink()
+
+
+def run_plan(plan, run_step, workers, progress=None, validate=None, checkpoint=None):
+    """Execute the steps of the plan on a pool of at most 'workers'
+    threads. Each step is started as soon as all the steps it depends on
+    are done. run_step(i, answers) is called with a copy of the answers
+    known so far and must return the answerdict of step i.
+    If given, validate(i, answers, answerdict) is run in the background
+    and returns answerdict if it's valid or a corrected answerdict, see
+    PlanState. The steps already in checkpoint are not run again.
+    Returns a dict mapping the index of each step to its answerdict.
+    If a step raises, the steps still running are stopped at their next
+    LLM or tool call by cancelling their budget."""
+    state = PlanState(plan, validate is not None, progress, checkpoint)
+    budget = Budget(parent=CURRENT_BUDGET.get())
+    running = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    # the checks don't take the place of the steps
+    checker = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        while not state.finished():
+            for job in state.jobs():
+                kind, i, answers, _ = job
+                # copy the context so that callbacks like get_openai_callback
+                # keep working in the worker threads
+                ctx = contextvars.copy_context()
+                ctx.run(CURRENT_BUDGET.set, budget)
+                if kind == "step":
+                    running[executor.submit(ctx.run, run_step, i, answers)] = job
+                else:
+                    running[checker.submit(ctx.run, validate, i, answers, state.results[i])] = job
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                state.done(running.pop(future), future.result())
+    finally:
+        budget.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+        checker.shutdown(wait=False, cancel_futures=True)
+    return state.results
+
+
+async def arun_plan(plan, run_step, workers, progress=None, validate=None, checkpoint=None):
+    """Async version of run_plan: at most 'workers' steps are awaited
+    at the same time, run_step and validate must be coroutine functions."""
+    semaphore = asyncio.Semaphore(max(1, workers))
+    state = PlanState(plan, validate is not None, progress, checkpoint)
+    budget = Budget(parent=CURRENT_BUDGET.get())
+    running = {}
+
+    async def step(i, answers):
+        # each task has its own copy of the context
+        CURRENT_BUDGET.set(budget)
+        async with semaphore:
+            return await run_step(i, answers)
+
+    async def check(i, answers, answerdict):
+        CURRENT_BUDGET.set(budget)
+        return await validate(i, answers, answerdict)
+
+    try:
+        while not state.finished():
+            for job in state.jobs():
+                kind, i, answers, _ = job
+                if kind == "step":
+                    running[asyncio.ensure_future(step(i, answers))] = job
+                else:
+                    running[asyncio.ensure_future(check(i, answers, state.results[i]))] = job
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                state.done(running.pop(task), task.result())
+    finally:
+        # the tasks cancelled while in a thread stop at their next call
+        budget.cancel()
+        for task in running:
+            task.cancel()
+    return state.results
+
+
+def looks_valid(answerdict):
+    """Cheap check of the answer of a step, True if it obviously doesn't
+    need the LLM validator: long enough, not an error or a give up, and
+    its last tool call didn't fail."""
+    output = answerdict["output"].strip()
+    if len(output) < MIN_VALID_ANSWER_CHARS or DOUBTFUL_ANSWER_RE.search(output):
+        return False
+    steps = answerdict.get("intermediate_steps") or []
+    return not steps or not DOUBTFUL_ANSWER_RE.search(str(steps[-1][1])[:200])
+
+
+def bigtask_answer(steps, answers):
+    "format the output of BigTask, the last answer being the final one"
+    final_answer = f"Assistant, return the complete following text as the final answer instead of just extracting the last few lines like you used to:\n'''\nI split the question into intermediate steps then tried to reason step by step.\nSteps:\n"
+    for i, step in enumerate(steps):
+        step = f"\n{i+1}. {step}. Answer:\n"
+        step += textwrap.indent(answers[i], "    ")
+        step = step.replace(r"\\n", "\n")
+        final_answer += step
+    final_answer += f"\nThe answer is: '{answers[-1]}'\n'''"
+    return final_answer
+
+
+def has_async(tool):
+    "True if the langchain tool has a real async implementation"
+    from langchain.tools import BaseTool, Tool, StructuredTool
+    if isinstance(tool, (Tool, StructuredTool)):
+        return tool.coroutine is not None
+    return type(tool)._arun is not BaseTool._arun
+
+
+async def arun_tool(tool, tool_input, callbacks=None):
+    """Run a langchain tool asynchronously, in a thread if it has no
+    async implementation. Contrary to langchain's own fallback,
+    asyncio.to_thread keeps the contextvars (e.g. get_openai_callback)."""
+    if has_async(tool):
+        return await tool.arun(tool_input, callbacks=callbacks)
+    return await asyncio.to_thread(tool.run, tool_input, callbacks=callbacks)
+
+
+def query_input_schema():
+    "args_schema of the tools taking a single query string"
+    from langchain.pydantic_v1 import BaseModel
+
+    class QueryInput(BaseModel):
+        query: str
+
+    return QueryInput
+
+
+def wrap_tool(tool, run, arun, **fields):
+    """returns a tool with the fields of tool (name, description, args
+    schema, return_direct...) but run by run(tool_input, callbacks) and
+    arun(tool_input, callbacks). fields override those of tool, which can
+    be None if they are all given."""
+    from langchain.tools import BaseTool, StructuredTool
+
+    def func(*args, callbacks=None, **kwargs):
+        return run(args[0] if args else kwargs, callbacks)
+
+    async def coroutine(*args, callbacks=None, **kwargs):
+        return await arun(args[0] if args else kwargs, callbacks)
+
+    # the callbacks of tool are still called by tool itself
+    kept = {
+            field: getattr(tool, field) for field in BaseTool.__fields__
+            if tool is not None and field not in ("callbacks", "callback_manager")}
+    kept.update(fields)
+    kept["args_schema"] = kept.get("args_schema") or query_input_schema()
+    return StructuredTool(func=func, coroutine=coroutine, **kept)
+
+
+def with_async_fallback(tool):
+    """Wrap a tool without async implementation so that its async call
+    is run with asyncio.to_thread."""
+    if has_async(tool):
+        return tool
+    return wrap_tool(
+            tool,
+            lambda tool_input, callbacks: tool.run(tool_input, callbacks=callbacks),
+            lambda tool_input, callbacks: arun_tool(tool, tool_input, callbacks))
+
+
+def truncate(text, max_tokens):
+    "text cut to about max_tokens tokens, see approx_tokens"
+    max_chars = max_tokens * 4
+    return text if len(text) <= max_chars else text[:max_chars] + "[...]"
+
+
+def cap_entries(entries, max_tokens):
+    """Joins the entries of an observation, leaving out those that
+    don't fit in max_tokens."""
+    max_chars = max_tokens * 4
+    observation = ""
+    for entry in entries:
+        if observation and len(observation) + len(entry) > max_chars:
+            break
+        observation += entry + "\n\n"
+    return truncate(observation.strip(), max_tokens)
+
+
+@functools.lru_cache(maxsize=None)
+def text_extractor_class():
+    """Returns the TextExtractor class, created on demand to not import
+    html.parser when the plugin is loaded."""
+    from html.parser import HTMLParser
+
+    class TextExtractor(HTMLParser):
+        """Streaming HTML to text conversion, skipping the boilerplate
+        (scripts, navigation, footers, forms, cookie banners...) and
+        telling when max_chars of text were found so that the rest of
+        the page isn't parsed."""
+
+        def __init__(self, max_chars):
+            super().__init__(convert_charrefs=True)
+            self.max_chars = max_chars
+            self.parts = []
+            self.length = 0
+            self.skipping = None  # tag of the boilerplate element being skipped
+            self.depth = 0  # of the elements of that tag being skipped
+
+        @property
+        def full(self):
+            return self.length > self.max_chars
+
+        def handle_starttag(self, tag, attrs):
+            if self.skipping:
+                if tag == self.skipping:
+                    self.depth += 1
+            elif tag not in VOID_TAGS and is_boilerplate(tag, attrs):
+                self.skipping, self.depth = tag, 1
+            elif tag in BLOCK_TAGS:
+                self.parts.append("\n")
+
+        def handle_startendtag(self, tag, attrs):
+            if not self.skipping and tag in BLOCK_TAGS:
+                self.parts.append("\n")
+
+        def handle_endtag(self, tag):
+            if self.skipping:
+                if tag == self.skipping:
+                    self.depth -= 1
+                    if not self.depth:
+                        self.skipping = None
+            elif tag in BLOCK_TAGS:
+                self.parts.append("\n")
+
+        def handle_data(self, data):
+            if self.skipping or not data.strip():
+                return
+            # keep the spaces around inline elements
+            text = " ".join(data.split())
+            if data[0].isspace():
+                text = " " + text
+            if data[-1].isspace():
+                text += " "
+            self.parts.append(text)
+            self.length += len(text)
+
+    return TextExtractor
+
+
+def is_boilerplate(tag, attrs):
+    if tag in BOILERPLATE_TAGS:
+        return True
+    attrs = dict(attrs)
+    if attrs.get("role") in BOILERPLATE_ROLES or "hidden" in attrs or attrs.get("aria-hidden") == "true":
+        return True
+    return bool(BOILERPLATE_RE.search(f"{attrs.get('id') or ''} {attrs.get('class') or ''}"))
+
+
+def html_to_text(html, max_chars):
+    """Text of the html page without its boilerplate, cut to max_chars.
+    The page is parsed by chunks, stopping at the first one that gives
+    enough text."""
+    parser = text_extractor_class()(max_chars)
+    for i in range(0, len(html), HTML_CHUNK_CHARS):
+        parser.feed(html[i:i + HTML_CHUNK_CHARS])
+        if parser.full:
+            break
+    else:
+        parser.close()
+    lines = (" ".join(line.split()) for line in "".join(parser.parts).splitlines())
+    text = "\n".join(line for line in lines if line)
+    if len(text) > max_chars:
+        text = text[:max_chars] + "[...]"
+    return text
+
+
+def split_results(output):
+    """The results found in the output of a search tool, as dicts with
+    their title and url when they can be found in the text."""
+    if isinstance(output, str) and output.startswith("[{"):
+        # list of results of tavily, as a string if it came from the cache
+        try:
+            output = ast.literal_eval(output)
+        except (ValueError, SyntaxError):
+            pass
+    if isinstance(output, list):
+        chunks = [
+                f"{r.get('url', '')}\n{r.get('content', '')}" if isinstance(r, dict) else str(r)
+                for r in output]
+    else:
+        # wikipedia, arxiv and pubmed separate their results by an empty
+        # line, metaphor_search lists them as '- url :'
+        chunks = re.split(r"\n\s*\n|\n- (?=https?://)", str(output))
+    results = []
+    for chunk in chunks:
+        chunk = chunk.strip()
+        # skip the empty results and the headers like "Here's the result of the search:"
+        if not chunk or (chunk.endswith(":") and "\n" not in chunk):
+            continue
+        title = re.search(r"^(?:Page|Title): *(.+)$", chunk, re.M)
+        url = re.search(r"https?://[^\s'\"<>)\]]+", chunk)
+        results.append({
+            "title": title.group(1).strip() if title else None,
+            "url": url.group(0).rstrip(".,:") if url else None,
+            "text": chunk,
+            })
+    return results
+
+
+def result_key(result):
+    "results with the same key are duplicates"
+    if result["url"]:
+        url = re.sub(r"^https?://(www\.)?", "", result["url"].lower())
+        return "url:" + url.rstrip("/")
+    if result["title"]:
+        return "title:" + " ".join(tokenize(result["title"]))
+    return "text:" + " ".join(tokenize(result["text"])[:30])
+
+
+def merge_results(query, outputs, max_tokens=DEFAULT_OBSERVATION_TOKENS, result_tokens=DEFAULT_RESULT_TOKENS):
+    """Merge the outputs of several search tools, given as (name, output),
+    into a single observation of at most max_tokens: the results are
+    deduplicated and ranked by their BM25 score for the query times the
+    number of tools that found them."""
+    merged = {}
+    for name, output in outputs:
+        for result in split_results(output):
+            key = result_key(result)
+            if key not in merged:
+                merged[key] = dict(result, sources=[])
+            if name not in merged[key]["sources"]:
+                merged[key]["sources"].append(name)
+    results = list(merged.values())
+
+    index = BM25Index()
+    for result in results:
+        index.add(result["text"])
+    scores = {i: score for score, i in index.search(query)}
+    ranked = sorted(
+            range(len(results)),
+            key=lambda i: (1 + scores.get(i, 0)) * len(results[i]["sources"]),
+            reverse=True)
+
+    entries = [
+            f"[{', '.join(results[i]['sources'])}]\n{truncate(results[i]['text'], result_tokens)}"
+            for i in ranked]
+    return cap_entries(entries, max_tokens) or "No results found."
+
+
+def meta_search_tool(
+        backends,
+        breakers,
+        max_tokens=DEFAULT_OBSERVATION_TOKENS,
+        result_tokens=DEFAULT_RESULT_TOKENS,
+        timeout=DEFAULT_META_SEARCH_TIMEOUT,
+        ):
+    """Tool querying all the search tools of backends at once, except
+    those whose circuit breaker is open. Those that don't answer within
+    timeout seconds, or the time left in the question's budget, are
+    ignored."""
+    from langchain.tools import StructuredTool
+
+    def available():
+        return [t for t in backends if t.name not in breakers or breakers[t.name].available()]
+
+    def failed(tool, output):
+        # see resilient_tool
+        return isinstance(output, str) and output.startswith(f"The tool {tool.name} failed")
+
+    def run(*args, callbacks=None, **kwargs):
+        query = args[0] if args else kwargs["query"]
+        tools = available()
+        executor = ThreadPoolExecutor(max_workers=max(1, len(tools)))
+        futures = [
+                executor.submit(contextvars.copy_context().run, t.run, {"query": query}, callbacks=callbacks)
+                for t in tools]
+        done, _ = wait(futures, timeout=time_left(timeout))
+        # the searches that timed out finish in the background
+        executor.shutdown(wait=False)
+        outputs = []
+        for t, future in zip(tools, futures):
+            if future not in done or future.exception() is not None:
+                continue
+            if not failed(t, future.result()):
+                outputs.append((t.name, future.result()))
+        return merge_results(query, outputs, max_tokens, result_tokens)
+
+    async def arun(*args, callbacks=None, **kwargs):
+        query = args[0] if args else kwargs["query"]
+        tools = available()
+        outputs = await asyncio.gather(
+                *[asyncio.wait_for(arun_tool(t, {"query": query}, callbacks), time_left(timeout)) for t in tools],
+                return_exceptions=True)
+        return merge_results(query, [
+            (t.name, output) for t, output in zip(tools, outputs)
+            if not isinstance(output, BaseException) and not failed(t, output)],
+            max_tokens, result_tokens)
+
+    return StructuredTool(
+            name="meta_search",
+            description=(
+                f"Searches with all these search engines at once: {', '.join(t.name for t in backends)}, "
+                "and returns their best results without duplicates. Use it first for any search. "
+                "Input should be a search query."),
+            func=run,
+            coroutine=arun,
+            args_schema=query_input_schema(),
+            )
+
+
+def time_left(timeout):
+    "timeout, reduced to the time left in the budget of the question"
+    budget = CURRENT_BUDGET.get()
+    remaining = budget.remaining() if budget is not None else None
+    return timeout if remaining is None else max(0, min(timeout, remaining))
+
+
+class BrowserPool:
+    """Headless chromium driven by async playwright in its own thread and
+    event loop, so that it can be used from any thread: the sync API of
+    playwright only works in the thread that started it. Pages are loaded
+    in at most size isolated contexts at once and closed right after, the
+    images, fonts and media being blocked if block_resources."""
+
+    def __init__(self, size=DEFAULT_BROWSER_PAGES, block_resources=DEFAULT_BROWSER_BLOCK_RESOURCES):
+        self.size = size
+        self.block_resources = block_resources
+        self.loop = asyncio.new_event_loop()
+        # the thread of the loop is only started once the browser runs
+        try:
+            self.loop.run_until_complete(self._start())
+        except BaseException:
+            self.loop.close()
+            raise
+        threading.Thread(target=self.loop.run_forever, name="browser", daemon=True).start()
+
+    def run(self, coro):
+        "result of coro, run in the loop of the browser"
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def arun(self, coro):
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    async def _start(self):
+        from playwright.async_api import async_playwright
+        from langchain.agents.agent_toolkits import PlayWrightBrowserToolkit
+        self.playwright = await async_playwright().start()
+        try:
+            self.browser = await self.playwright.chromium.launch(headless=True)
+        except BaseException:
+            await self.playwright.stop()
+            raise
+        self.slots = asyncio.Semaphore(self.size)
+        self.idle = []  # contexts not loading a page
+        # the interactive tools (navigate_browser...) use the last page
+        # of the first context
+        await (await self._new_context()).new_page()
+        toolkit = PlayWrightBrowserToolkit.from_browser(async_browser=self.browser)
+        self.tools = {t.name: self._wrap(t) for t in toolkit.get_tools()}
+
+    async def _new_context(self):
+        context = await self.browser.new_context()
+        if self.block_resources:
+            await context.route("**/*", self._block)
+        return context
+
+    @staticmethod
+    async def _block(route):
+        if route.request.resource_type in BLOCKED_RESOURCES:
+            await route.abort()
+        else:
+            await route.continue_()
+
+    def _wrap(self, tool):
+        """tool of the playwright toolkit, run in the loop of the browser.
+        extract_text uses html_to_text instead of the whole text of the page."""
+        from langchain.tools.playwright.utils import aget_current_page
+
+        async def call(tool_input):
+            if tool.name != "extract_text":
+                return await tool.arun(tool_input)
+            page = await aget_current_page(self.browser)
+            return await self._extract(await page.content())
+
+        return wrap_tool(
+                tool,
+                lambda tool_input, callbacks: self.run(call(tool_input)),
+                lambda tool_input, callbacks: self.arun(call(tool_input)))
+
+    async def _fetch(self, url, timeout):
+        async with self.slots:
+            context = self.idle.pop() if self.idle else await self._new_context()
+            page = await context.new_page()
+            try:
+                await page.goto(url, timeout=timeout * 1000, wait_until="domcontentloaded")
+                html = await page.content()
+            finally:
+                await page.close()
+                self.idle.append(context)
+        return await self._extract(html)
+
+    async def _extract(self, html):
+        # in a thread, so that the other pages keep loading meanwhile
+        return await asyncio.get_running_loop().run_in_executor(None, html_to_text, html, PAGE_TEXT_CHARS)
+
+    async def _fetch_many(self, urls, timeout):
+        return await asyncio.gather(*[self._fetch(url, timeout) for url in urls], return_exceptions=True)
+
+    def fetch_many(self, urls, timeout=DEFAULT_PAGE_TIMEOUT):
+        "text of the pages at urls, or the exception raised when loading them"
+        return self.run(self._fetch_many(urls, time_left(timeout)))
+
+    async def afetch_many(self, urls, timeout=DEFAULT_PAGE_TIMEOUT):
+        return await self.arun(self._fetch_many(urls, time_left(timeout)))
+
+    def close(self):
+        self.run(self.browser.close())
+        self.run(self.playwright.stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def fetch_pages_input_schema():
+    from langchain.pydantic_v1 import BaseModel, Field as V1Field
+
+    class FetchPagesInput(BaseModel):
+        urls: list[str] = V1Field(description=f"urls of the pages, at most {MAX_FETCHED_PAGES}")
+
+    return FetchPagesInput
+
+
+def fetch_pages_tool(pool, cache=None, max_tokens=DEFAULT_OBSERVATION_TOKENS, result_tokens=DEFAULT_RESULT_TOKENS):
+    """Tool loading several web pages at once with the BrowserPool pool
+    and returning their text, each page getting its share of max_tokens
+    but no more than result_tokens. The texts are cached by url in
+    cache, a SQLiteLRU, for PAGE_CACHE_TTL seconds."""
+    from langchain.tools import StructuredTool
+
+    def cached(urls):
+        if cache is None:
+            return {}
+        texts = {url: cache.get("page", url, PAGE_CACHE_TTL) for url in urls}
+        return {url: text for url, text in texts.items() if text is not None}
+
+    def store(texts):
+        if cache is None:
+            return
+        for url, text in texts.items():
+            if isinstance(text, str):
+                cache.set("page", url, text)
+
+    def observation(urls, texts):
+        page_tokens = min(result_tokens, max_tokens // len(urls))
+        pages = []
+        for url in urls:
+            text = texts[url]
+            if isinstance(text, BaseException):
+                pages.append(f"{url} :\nError when loading the page: {text}")
+            else:
+                pages.append(f"{url} :\n{truncate(text, page_tokens)}")
+        return cap_entries(pages, max_tokens)
+
+    def run(urls, callbacks=None):
+        urls = list(dict.fromkeys(urls))[:MAX_FETCHED_PAGES]
+        texts = cached(urls)
+        missing = [url for url in urls if url not in texts]
+        if missing:
+            fetched = dict(zip(missing, pool.fetch_many(missing)))
+            store(fetched)
+            texts.update(fetched)
+        return observation(urls, texts)
+
+    async def arun(urls, callbacks=None):
+        urls = list(dict.fromkeys(urls))[:MAX_FETCHED_PAGES]
+        texts = await asyncio.to_thread(cached, urls)
+        missing = [url for url in urls if url not in texts]
+        if missing:
+            fetched = dict(zip(missing, await pool.afetch_many(missing)))
+            await asyncio.to_thread(store, fetched)
+            texts.update(fetched)
+        return observation(urls, texts)
+
+    return StructuredTool(
+            name="fetch_pages",
+            description=(
+                "Loads several web pages at once and returns their text. "
+                "Use it instead of the browser tools when you already know the urls to read."),
+            func=run,
+            coroutine=arun,
+            args_schema=fetch_pages_input_schema(),
+            )
+
+
+def capped_tool(tool, max_tokens):
+    "returns tool with its output cut to max_tokens"
+
+    def run(tool_input, callbacks):
+        return truncate(str(tool.run(tool_input, callbacks=callbacks)), max_tokens)
+
+    async def arun(tool_input, callbacks):
+        return truncate(str(await arun_tool(tool, tool_input, callbacks)), max_tokens)
+
+    return wrap_tool(tool, run, arun)
+
+
+def shell_tool_in(cwd=None):
+    "ShellTool running its commands in cwd, if given, instead of the current directory"
+    from langchain.tools import ShellTool
+    tool = ShellTool()
+    if cwd is None:
+        return tool
+
+    def in_cwd(tool_input):
+        commands = tool_input["commands"] if isinstance(tool_input, dict) else tool_input
+        if not isinstance(commands, str):
+            commands = ";".join(commands)
+        return {"commands": f"cd {shlex.quote(cwd)} || exit 1\n{commands}"}
+
+    def run(tool_input, callbacks):
+        return tool.run(in_cwd(tool_input), callbacks=callbacks)
+
+    async def arun(tool_input, callbacks):
+        return await arun_tool(tool, in_cwd(tool_input), callbacks)
+
+    return wrap_tool(tool, run, arun)
+
+
+class SharedResources:
+    """Resources that are expensive to create and shared by all the
+    configured agents of the process: LLM clients, browser, caches,
+    memory store and indexes, the chat histories of the sessions, and
+    the rate limits and circuit breakers of the providers."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.llms = {}
+        self.browsers = {}
+        self.page_cache = None
+        self.tool_cache = None
+        self.llm_cache = None
+        self.memory_store = None
+        self.memory_indexes = {}
+        self.chat_histories = {}
+        self.tracer = None
+        self.cassettes = {}
+        self.buckets = {}
+        self.breakers = {}
+
+    def agent_dir(self):
+        llm_agent = llm.user_dir() / "agent"
+        llm_agent.mkdir(exist_ok=True, parents=True)
+        return llm_agent
+
+    def get_llm(self, model, temperature, cache, verbose, timeout=None, streaming=False):
+        """If timeout is given, the model is not retried: it's the primary
+        model of a FallbackChatModel. The streaming models are distinct
+        instances, that are only used by the agents answering in stream."""
+        with self.lock:
+            key = (model, temperature, cache, verbose, timeout, streaming)
+            if key not in self.llms:
+                from langchain.chat_models import ChatOpenAI
+                self.llms[key] = (streaming_chat_model_class() if streaming else ChatOpenAI)(
+                        model_name=model,
+                        temperature=temperature,
+                        verbose=verbose,
+                        streaming=streaming,
+                        # False makes sure to ignore the cache when disabled
+                        cache=cache,
+                        max_retries=DEFAULT_LLM_RETRIES if timeout is None else 0,
+                        request_timeout=timeout,
+                        )
+            return self.llms[key]
+
+    def get_llm_cache(self):
+        with self.lock:
+            if self.llm_cache is None:
+                from langchain.globals import set_llm_cache
+                self.llm_cache = LLMCache(self.agent_dir() / "llm_cache.db", DEFAULT_LLM_CACHE_SIZE)
+                set_llm_cache(self.llm_cache)
+            return self.llm_cache
+
+    def get_tool_cache(self):
+        with self.lock:
+            if self.tool_cache is None:
+                self.tool_cache = ToolCache(self.agent_dir() / "tool_cache.db")
+            return self.tool_cache
+
+    def get_tracer(self):
+        with self.lock:
+            if self.tracer is None:
+                agent_dir = self.agent_dir()
+                self.tracer = Tracer(agent_dir / "traces.jsonl", agent_dir / "metrics.prom")
+            return self.tracer
+
+    def get_cassette(self, path, mode):
+        with self.lock:
+            if (path, mode) not in self.cassettes:
+                self.cassettes[(path, mode)] = Cassette(path, mode)
+            return self.cassettes[(path, mode)]
+
+    def get_bucket(self, provider, rpm, burst=1):
+        "TokenBucket limiting the calls to provider to rpm per minute"
+        with self.lock:
+            if (provider, rpm) not in self.buckets:
+                self.buckets[(provider, rpm)] = TokenBucket(rpm / 60, burst)
+            return self.buckets[(provider, rpm)]
+
+    def get_breaker(self, name):
+        with self.lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker()
+            return self.breakers[name]
+
+    def get_memory_store(self):
+        with self.lock:
+            if self.memory_store is None:
+                self.memory_store = MemoryStore(self.agent_dir() / "memories.db")
+            return self.memory_store
+
+    def get_memory_index(self, user, verbose=True):
+        "BM25 index of the persistent memories of user"
+        with self.lock:
+            if user not in self.memory_indexes:
+                store = self.get_memory_store()
+                json_memories = self.agent_dir() / f"{user}.json"
+                if json_memories.exists():
+                    n = store.migrate_json(user, json_memories)
+                    print(f"(Migrated {n} memories from {json_memories})")
+
+                index = BM25Index()
+                for mem in store.get(user):
+                    index.add(mem["message"])
+                if verbose:
+                    print(f"(Loaded {len(index.texts)} memories)")
+                self.memory_indexes[user] = index
+            return self.memory_indexes[user]
+
+    def get_browser(self, size, block_resources):
+        "BrowserPool, launched on first use. A failed launch is not retried."
+        with self.lock:
+            if (size, block_resources) not in self.browsers:
+                try:
+                    self.browsers[(size, block_resources)] = BrowserPool(size, block_resources)
+                except Exception as err:
+                    self.browsers[(size, block_resources)] = err
+            browser = self.browsers[(size, block_resources)]
+            if isinstance(browser, Exception):
+                raise browser
+            return browser
+
+    def get_page_cache(self):
+        with self.lock:
+            if self.page_cache is None:
+                self.page_cache = SQLiteLRU(self.agent_dir() / "page_cache.db", DEFAULT_PAGE_CACHE_SIZE)
+            return self.page_cache
+
+    def get_chat_history(self, session):
+        with self.lock:
+            if session not in self.chat_histories:
+                from langchain.memory import ChatMessageHistory
+                self.chat_histories[session] = ChatMessageHistory()
+            return self.chat_histories[session]
+
+
+class AgentPool:
+    """Configured agents cached by options and session, the least
+    recently used being dropped when there are more than max_size.
+    The agents of a session share its chat history so that the options
+    can be changed in the middle of a conversation."""
+
+    def __init__(self, max_size=DEFAULT_POOL_SIZE, shared=None):
+        self.max_size = max_size
+        self.shared = shared or SharedResources()
+        self.agents = OrderedDict()
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    @staticmethod
+    def key(options, session):
+        options = json.dumps(options, sort_keys=True, default=str)
+        return hashlib.sha256(options.encode()).hexdigest(), session
+
+    def get(self, options, session="default"):
+        "returns the agent configured with those options, creating it if needed"
+        key = self.key(options, session)
+        with self.lock:
+            if key in self.agents:
+                self.agents.move_to_end(key)
+                return self.agents[key]
+            # a slow configuration doesn't block the other ones
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                if key in self.agents:
+                    return self.agents[key]
+            agent = ConfiguredAgent(options, self.shared, self.shared.get_chat_history(session))
+            with self.lock:
+                self.agents[key] = agent
+                self.key_locks.pop(key, None)
+                while len(self.agents) > self.max_size:
+                    (_, old_session), _ = self.agents.popitem(last=False)
+                    if all(s != old_session for _, s in self.agents):
+                        self.shared.chat_histories.pop(old_session, None)
+        return agent
+
+
+def daemon_socket():
+    "default path of the unix socket of the daemon"
+    return str(llm.user_dir() / "agent" / "daemon.sock")
+
+
+def connect_daemon(path=None):
+    "returns a socket connected to the daemon, or None if it's not running"
+    path = path or daemon_socket()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        # stale socket of a daemon that was killed
+        sock.close()
+        return None
+    return sock
+
+
+def daemon_chunks(sock, request):
+    """Send a request to the daemon and yield the chunks of its answer.
+    The protocol is one JSON object per line: the client sends
+    {"prompt", "options", "session", "stream", "cwd"} and the daemon answers
+    with {"chunk": str} lines then {"done": true} or {"error": str}."""
+    with sock, sock.makefile("rw", encoding="utf-8") as f:
+        f.write(json.dumps(request) + "\n")
+        f.flush()
+        for line in f:
+            message = json.loads(line)
+            if "error" in message:
+                raise click.ClickException(f"Error from the agent daemon: {message['error']}")
+            if message.get("done"):
+                return
+            yield message["chunk"]
+    raise click.ClickException("The agent daemon closed the connection")
+
+
+def serve_daemon(path, pool):
+    "answer the requests sent to the unix socket at path until interrupted"
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def send(self, message):
+            self.wfile.write((json.dumps(message) + "\n").encode())
+
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+                options = Agent.Options(**request["options"]).model_dump()
+                # the tools work in the directory of the client
+                options.update(cwd=request.get("cwd"), interactive=False)
+                # requests outside of a conversation get a new session
+                session = request.get("session") or os.urandom(8).hex()
+                agent = pool.get(options, session)
+                for chunk in agent.execute(request["prompt"], request.get("stream", True)):
+                    self.send({"chunk": chunk})
+                self.send({"done": True})
+            except (BrokenPipeError, ConnectionResetError):
+                print("(Client disconnected)")
+            except Exception as err:
+                print(f"Error when answering request: {err}")
+                self.send({"error": str(err)})
+
+    if connect_daemon(path) is not None:
+        raise click.ClickException(f"A daemon is already listening on {path}")
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    os.chmod(path, 0o600)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def rate_limit_handler(bucket):
+    "callback handler waiting for the TokenBucket before each LLM request"
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    class RateLimitHandler(BaseCallbackHandler):
+        # also called for chat models
+        def on_llm_start(self, serialized, prompts, **kwargs):
+            bucket.acquire()
+
+    return RateLimitHandler()
+
+
+def read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_batch(questions, output, pool, concurrency, rpm=None, options=None):
+    """Answer the questions concurrently, appending a JSON line per
+    answer to output in the order of the questions. The questions whose
+    id already has an answer without error in output are skipped, and at
+    the end output is rewritten with one line per id in input order.
+    Each question is a dict with a 'question', an optional 'id' (its line
+    number by default) and optional 'options' overriding those given."""
+    from tqdm import tqdm
+
+    for i, q in enumerate(questions):
+        q.setdefault("id", i + 1)
+    done = set()
+    if os.path.exists(output):
+        done = {r["id"] for r in read_jsonl(output) if not r.get("error")}
+    todo = [q for q in questions if q["id"] not in done]
+    print(f"(Batch: {len(done)} questions already answered, {len(todo)} to go)")
+
+    callbacks = [rate_limit_handler(TokenBucket(rpm / 60))] if rpm else []
+
+    def answer(q):
+        t = time.time()
+        result = {"id": q["id"], "question": q["question"]}
+        try:
+            opts = Agent.Options(**{"quiet": True, **(options or {}), **q.get("options", {})}).model_dump()
+            # each question is its own conversation
+            agent = pool.get(opts, session=f"batch-{q['id']}")
+            answerdict, cb = agent.answer(q["question"], callbacks=callbacks)
+            result["output"] = answerdict["output"]
+            result["intermediate_steps"] = [
+                    {"tool": action.tool, "tool_input": action.tool_input, "observation": str(observation)}
+                    for action, observation in answerdict["intermediate_steps"]
+                    ]
+            result.update(
+                    total_tokens=cb.total_tokens,
+                    prompt_tokens=cb.prompt_tokens,
+                    completion_tokens=cb.completion_tokens,
+                    total_cost=cb.total_cost,
+                    )
+        except Exception as err:
+            result["error"] = str(err)
+        result["duration"] = time.time() - t
+        return result
+
+    with ThreadPoolExecutor(concurrency) as executor, open(output, "a", encoding="utf-8") as f:
+        # map yields in input order
+        for result in tqdm(executor.map(answer, todo), total=len(todo), desc="Batch", unit="question"):
+            f.write(json.dumps(result) + "\n")
+            f.flush()
+
+    results = {r["id"]: r for r in read_jsonl(output)}
+    order = [q["id"] for q in questions] + [i for i in results if i not in {q["id"] for q in questions}]
+    with open(output + ".tmp", "w", encoding="utf-8") as f:
+        for i in order:
+            if i in results:
+                f.write(json.dumps(results[i]) + "\n")
+    os.replace(output + ".tmp", output)
+    return [results[q["id"]] for q in questions if q["id"] in results]
+
+
+@llm.hookimpl
+def register_commands(cli):
+    @cli.group(name="agent")
+    def agent_group():
+        "Commands of the llm_agent plugin"
+
+    @agent_group.command(name="memories")
+    @click.argument("user")
+    @click.option("--compact", is_flag=True, help="Remove the duplicated memories and reclaim disk space")
+    def memories_command(user, compact):
+        "List the persistent memories of USER"
+        shared = SharedResources()
+        # migrates the json memories of older versions
+        shared.get_memory_index(user, verbose=False)
+        store = shared.get_memory_store()
+        if compact:
+            click.echo(f"Removed {store.compact(user)} duplicated memories")
+        for mem in store.get(user):
+            click.echo(f"{datetime.fromtimestamp(mem['timestamp'])}: {mem['message']}")
+
+    @agent_group.command(name="daemon")
+    @click.option("--socket", "path", default=None, help="Path of the unix socket, by default in the agent folder of llm's user directory")
+    @click.option("--pool-size", default=32, show_default=True, help="Maximum number of configured agents kept in memory, one per options and conversation")
+    def daemon_command(path, pool_size):
+        """Keep agents, browser and caches loaded and answer the prompts of
+        'llm -m agent' through a unix socket, avoiding its startup cost"""
+        path = path or daemon_socket()
+        pool = AgentPool(max_size=pool_size)
+        # import everything and build an agent with the default options
+        pool.get(Agent.Options().model_dump(), "warmup")
+        click.echo(f"Agent daemon listening on {path}")
+        serve_daemon(path, pool)
+
+    @agent_group.command(name="batch")
+    @click.argument("input_path", metavar="INPUT", type=click.Path(exists=True, dir_okay=False))
+    @click.argument("output_path", metavar="OUTPUT", type=click.Path(dir_okay=False))
+    @click.option("-o", "--option", "options", type=(str, str), multiple=True, help="Option of the agent for all questions, e.g. -o bigtask_tool false")
+    @click.option("-c", "--concurrency", default=4, show_default=True, help="Number of questions answered at the same time")
+    @click.option("--rpm", type=int, default=None, help="Maximum number of LLM requests per minute, over all questions")
+    def batch_command(input_path, output_path, options, concurrency, rpm):
+        """Answer the questions of the JSONL file INPUT, writing the answers
+        as JSONL in OUTPUT. Each line of INPUT is like {"id": "q1", "question":
+        "...", "options": {"user": "bob"}}, id and options being optional.
+        Questions whose id already has an answer in OUTPUT are skipped so an
+        interrupted batch can be resumed."""
+        questions = read_jsonl(input_path)
+        pool = AgentPool(max_size=concurrency)
+        results = run_batch(questions, output_path, pool, concurrency, rpm, dict(options))
+        errors = sum(1 for r in results if r.get("error"))
+        cost = sum(r.get("total_cost", 0) for r in results)
+        click.echo(f"{len(results) - errors} answered, {errors} errors, total cost ${cost:.4f}")
 
 
 @llm.hookimpl
 def register_models(register):
-    register(Agent())
+    agent = Agent()
+    if hasattr(llm, "AsyncModel"):
+        register(agent, AsyncAgent(agent))
+    else:
+        register(agent)
 
 class Agent(llm.Model):
     VERSION = "0.3.1"
     model_id = "agent"
-    can_stream = False
+    can_stream = True
 
     class Options(llm.Options):
         quiet: Optional[bool] = Field(
@@ -67,17 +2882,20 @@ class Agent(llm.Model):
                 description="Model temperature",
                 default=DEFAULT_TEMP)
         timeout: Optional[int] = Field(
-                description="Agent timeout",
+                description="Maximum number of seconds to answer a question, the time left being split between the steps of BigTask",
                 default=DEFAULT_TIMEOUT)
         max_iter: Optional[int] = Field(
-                description="Agent max iteration",
+                description="Maximum number of iterations of the agent, and of BigTask's agent for each step",
                 default=DEFAULT_MAX_ITER)
         validate_subtask: Optional[bool] = Field(
-                description="If True, will use the LLM to check if answer to the subtask of BigTask. This can get expensive.",
+                description="If True, will use the LLM to check the answers to the subtasks of BigTask that don't obviously look valid, in the background while the next steps run. This can get expensive.",
                 default=DEFAULT_VALIDATE_SUBTASK)
         bigtask_tool: Optional[bool] = Field(
                 description="True to use subtasks",
                 default=DEFAULT_BIGTASK)
+        bigtask_workers: Optional[int] = Field(
+                description="Maximum number of independent BigTask steps executed concurrently",
+                default=DEFAULT_BIGTASK_WORKERS)
         user: Optional[str] = Field(
                 description="If a string, should be the name of the user and will be used for persistent memory.",
                 default=None)
@@ -94,6 +2912,73 @@ class Agent(llm.Model):
                 description="If True, will enable the tool to use the shell. Be careful.",
                 default=DEFAULT_SHELL)
 
+        tool_cache: Optional[bool] = Field(
+                description="If True, the results of the search tools are cached on disk.",
+                default=DEFAULT_TOOL_CACHE)
+        llm_cache: Optional[bool] = Field(
+                description="If True, the LLM completions are cached on disk. By default only enabled if the temperature is 0.",
+                default=DEFAULT_LLM_CACHE)
+        user_memory_k: Optional[int] = Field(
+                description="Maximum number of persistent memories given to the LLM, the most relevant to the question being selected.",
+                default=DEFAULT_USER_MEMORY_K)
+        user_memory_tokens: Optional[int] = Field(
+                description="Maximum number of tokens of persistent memories given to the LLM.",
+                default=DEFAULT_USER_MEMORY_TOKENS)
+        chat_memory_tokens: Optional[int] = Field(
+                description="If set, approximate maximum number of tokens of conversation given to the agent, older messages being summarized.",
+                default=DEFAULT_CHAT_MEMORY_TOKENS)
+        sub_chat_memory_tokens: Optional[int] = Field(
+                description="Same as chat_memory_tokens but for the agent of BigTask.",
+                default=DEFAULT_SUB_CHAT_MEMORY_TOKENS)
+        trace: Optional[bool] = Field(
+                description="If True, the LLM calls, tool calls, BigTask plans, steps and validations are traced in traces.jsonl and their latency histograms written to metrics.prom, in the agent folder of llm's user directory.",
+                default=DEFAULT_TRACE)
+        cassette: Optional[str] = Field(
+                description="Path of a cassette file where the LLM requests and tool calls are recorded, or replayed from without network, see cassette_mode.",
+                default=None)
+        cassette_mode: Optional[str] = Field(
+                description="'record', 'replay', 'replay_timed' to wait the recorded latencies, or 'auto' to replay the cassette if it exists and record it otherwise.",
+                default="auto")
+        max_tokens: Optional[int] = Field(
+                description="If set, maximum number of tokens used to answer a question, BigTask included. The agent is stopped when it's reached.",
+                default=DEFAULT_MAX_TOKENS)
+        max_cost: Optional[float] = Field(
+                description="If set, maximum cost in dollars of the answer to a question, BigTask included. The agent is stopped when it's reached.",
+                default=DEFAULT_MAX_COST)
+        openai_rpm: Optional[int] = Field(
+                description="Maximum number of requests per minute to openai, shared by all the agents of the process",
+                default=DEFAULT_OPENAI_RPM)
+        meta_search: Optional[bool] = Field(
+                description="If True, the sub_agent gets a tool that queries all the search tools in parallel and merges their results",
+                default=DEFAULT_META_SEARCH)
+        browser_pages: Optional[int] = Field(
+                description="Number of web pages the browser can load at once, each in its own context",
+                default=DEFAULT_BROWSER_PAGES)
+        browser_block_resources: Optional[bool] = Field(
+                description="If True, the browser doesn't load the images, fonts and media of the pages",
+                default=DEFAULT_BROWSER_BLOCK_RESOURCES)
+        observation_tokens: Optional[int] = Field(
+                description="Maximum number of tokens of the observations of the web tools (meta_search, metaphor, fetch_pages, browser)",
+                default=DEFAULT_OBSERVATION_TOKENS)
+        result_tokens: Optional[int] = Field(
+                description="Maximum number of tokens of each search result or web page in an observation",
+                default=DEFAULT_RESULT_TOKENS)
+        resume: Optional[bool] = Field(
+                description="If True, a BigTask on the same question as one that was interrupted reuses its plan and the answers of its finished steps",
+                default=DEFAULT_RESUME)
+        routes: Optional[str] = Field(
+                description="Model and temperature of the roles agent, planner, step (of BigTask), validator and synthesis (of the final BigTask answer) as role=model or role=model@temperature, e.g. 'planner=gpt-3.5-turbo-1106@0,synthesis=gpt-4-1106-preview'. The other roles use openaimodel and temperature",
+                default=DEFAULT_ROUTES)
+        fallback_model: Optional[str] = Field(
+                description="If set, faster model called instead of the model of a role when it is rate limited, unavailable or slower than fallback_timeout",
+                default=DEFAULT_FALLBACK_MODEL)
+        fallback_timeout: Optional[int] = Field(
+                description="Seconds after which a call falls back to fallback_model",
+                default=DEFAULT_FALLBACK_TIMEOUT)
+        step_tools: Optional[int] = Field(
+                description="Number of tools given to BigTask's agent for each step, the most relevant to the step (the browser tools and the files tools each count as one). meta_search is always given. None gives every tool",
+                default=DEFAULT_STEP_TOOLS)
+
         @field_validator("quiet")
         def validate_quiet(cls, quiet):
             assert isinstance(quiet, bool), "Invalid type for quiet"
@@ -129,6 +3014,12 @@ class Agent(llm.Model):
             assert isinstance(bigtask_tool, bool), "Invalid type for bigtask_tool"
             return bigtask_tool
 
+        @field_validator("bigtask_workers")
+        def validate_bigtask_workers(cls, bigtask_workers):
+            assert isinstance(bigtask_workers, int), "Invalid type for bigtask_workers"
+            assert bigtask_workers >= 1, "bigtask_workers must be at least 1"
+            return bigtask_workers
+
         @field_validator("tavily_tool")
         def validate_tavily_tool(cls, tavily_tool):
             assert isinstance(tavily_tool, bool), "Invalid type for tavily_tool"
@@ -149,12 +3040,162 @@ class Agent(llm.Model):
             assert isinstance(shell_tool, bool), "Invalid type for shell_tool"
             return shell_tool
 
+        @field_validator("tool_cache")
+        def validate_tool_cache(cls, tool_cache):
+            assert isinstance(tool_cache, bool), "Invalid type for tool_cache"
+            return tool_cache
+
+        @field_validator("llm_cache")
+        def validate_llm_cache(cls, llm_cache):
+            if llm_cache is None:
+                return llm_cache
+            assert isinstance(llm_cache, bool), "Invalid type for llm_cache"
+            return llm_cache
+
+        @field_validator("user_memory_k")
+        def validate_user_memory_k(cls, user_memory_k):
+            assert isinstance(user_memory_k, int), "Invalid type for user_memory_k"
+            return user_memory_k
+
+        @field_validator("user_memory_tokens")
+        def validate_user_memory_tokens(cls, user_memory_tokens):
+            assert isinstance(user_memory_tokens, int), "Invalid type for user_memory_tokens"
+            return user_memory_tokens
+
+        @field_validator("chat_memory_tokens")
+        def validate_chat_memory_tokens(cls, chat_memory_tokens):
+            if chat_memory_tokens is None:
+                return chat_memory_tokens
+            assert isinstance(chat_memory_tokens, int), "Invalid type for chat_memory_tokens"
+            return chat_memory_tokens
+
+        @field_validator("sub_chat_memory_tokens")
+        def validate_sub_chat_memory_tokens(cls, sub_chat_memory_tokens):
+            if sub_chat_memory_tokens is None:
+                return sub_chat_memory_tokens
+            assert isinstance(sub_chat_memory_tokens, int), "Invalid type for sub_chat_memory_tokens"
+            return sub_chat_memory_tokens
+
+        @field_validator("trace")
+        def validate_trace(cls, trace):
+            assert isinstance(trace, bool), "Invalid type for trace"
+            return trace
+
+        @field_validator("cassette")
+        def validate_cassette(cls, cassette):
+            if cassette is None:
+                return cassette
+            assert isinstance(cassette, str), "Invalid type for cassette"
+            return cassette
+
+        @field_validator("cassette_mode")
+        def validate_cassette_mode(cls, cassette_mode):
+            assert isinstance(cassette_mode, str), "Invalid type for cassette_mode"
+            assert cassette_mode in Cassette.modes, f"cassette_mode must be one of {Cassette.modes}"
+            return cassette_mode
+
+        @field_validator("max_tokens")
+        def validate_max_tokens(cls, max_tokens):
+            if max_tokens is None:
+                return max_tokens
+            assert isinstance(max_tokens, int), "Invalid type for max_tokens"
+            return max_tokens
+
+        @field_validator("max_cost")
+        def validate_max_cost(cls, max_cost):
+            if max_cost is None:
+                return max_cost
+            assert isinstance(max_cost, float), "Invalid type for max_cost"
+            return max_cost
+
+        @field_validator("openai_rpm")
+        def validate_openai_rpm(cls, openai_rpm):
+            if openai_rpm is None:
+                return openai_rpm
+            assert isinstance(openai_rpm, int), "Invalid type for openai_rpm"
+            assert openai_rpm > 0, "openai_rpm must be positive"
+            return openai_rpm
+
+        @field_validator("meta_search")
+        def validate_meta_search(cls, meta_search):
+            assert isinstance(meta_search, bool), "Invalid type for meta_search"
+            return meta_search
+
+        @field_validator("browser_pages")
+        def validate_browser_pages(cls, browser_pages):
+            assert isinstance(browser_pages, int), "Invalid type for browser_pages"
+            assert browser_pages > 0, "browser_pages must be positive"
+            return browser_pages
+
+        @field_validator("browser_block_resources")
+        def validate_browser_block_resources(cls, browser_block_resources):
+            assert isinstance(browser_block_resources, bool), "Invalid type for browser_block_resources"
+            return browser_block_resources
+
+        @field_validator("observation_tokens")
+        def validate_observation_tokens(cls, observation_tokens):
+            assert isinstance(observation_tokens, int), "Invalid type for observation_tokens"
+            assert observation_tokens > 0, "observation_tokens must be positive"
+            return observation_tokens
+
+        @field_validator("result_tokens")
+        def validate_result_tokens(cls, result_tokens):
+            assert isinstance(result_tokens, int), "Invalid type for result_tokens"
+            assert result_tokens > 0, "result_tokens must be positive"
+            return result_tokens
+
+        @field_validator("resume")
+        def validate_resume(cls, resume):
+            assert isinstance(resume, bool), "Invalid type for resume"
+            return resume
+
+        @field_validator("routes")
+        def validate_routes(cls, routes):
+            if routes is None:
+                return routes
+            assert isinstance(routes, str), "Invalid type for routes"
+            parse_routes(routes)
+            return routes
+
+        @field_validator("fallback_model")
+        def validate_fallback_model(cls, fallback_model):
+            if fallback_model is None:
+                return fallback_model
+            assert isinstance(fallback_model, str), "Invalid type for fallback_model"
+            return fallback_model
+
+        @field_validator("fallback_timeout")
+        def validate_fallback_timeout(cls, fallback_timeout):
+            assert isinstance(fallback_timeout, int), "Invalid type for fallback_timeout"
+            assert fallback_timeout > 0, "fallback_timeout must be positive"
+            return fallback_timeout
+
+        @field_validator("step_tools", mode="before")
+        def parse_step_tools(cls, step_tools):
+            # -o step_tools none gives the string "none"
+            if isinstance(step_tools, str) and step_tools.lower() == "none":
+                return None
+            return step_tools
+
+        @field_validator("step_tools")
+        def validate_step_tools(cls, step_tools):
+            if step_tools is None:
+                return step_tools
+            assert isinstance(step_tools, int), "Invalid type for step_tools"
+            assert step_tools >= 1, "step_tools must be at least 1"
+            return step_tools
+
     def __init__(self):
-        self.configured = False
+        # the configured agents, one per set of options
+        self.pool = AgentPool()
 
         # if we qre certain that llm will use Agent then might as
         # well initialize it directly instead of waiting the first message
-        if "agent" not in sys.argv:
+        if "agent" not in sys.argv or sys.argv[1:2] == ["agent"]:
+            # e.g. 'llm agent daemon'
+            return
+        # unless a daemon will answer
+        if os.path.exists(daemon_socket()):
             return
         try:
             args = " ".join(sys.argv[1:]).replace("-o", "--option")
@@ -171,9 +3212,32 @@ class Agent(llm.Model):
                     "user": None,
                     "tavily_tool": False,
                     "bigtask_tool": DEFAULT_BIGTASK,
+                    "bigtask_workers": DEFAULT_BIGTASK_WORKERS,
                     "metaphor_tool": False,
                     "files_tool": DEFAULT_FILES,
                     "shell_tool": DEFAULT_SHELL,
+                    "tool_cache": DEFAULT_TOOL_CACHE,
+                    "llm_cache": DEFAULT_LLM_CACHE,
+                    "user_memory_k": DEFAULT_USER_MEMORY_K,
+                    "user_memory_tokens": DEFAULT_USER_MEMORY_TOKENS,
+                    "chat_memory_tokens": DEFAULT_CHAT_MEMORY_TOKENS,
+                    "sub_chat_memory_tokens": DEFAULT_SUB_CHAT_MEMORY_TOKENS,
+                    "trace": DEFAULT_TRACE,
+                    "cassette": None,
+                    "cassette_mode": "auto",
+                    "max_tokens": DEFAULT_MAX_TOKENS,
+                    "max_cost": DEFAULT_MAX_COST,
+                    "openai_rpm": DEFAULT_OPENAI_RPM,
+                    "meta_search": DEFAULT_META_SEARCH,
+                    "browser_pages": DEFAULT_BROWSER_PAGES,
+                    "browser_block_resources": DEFAULT_BROWSER_BLOCK_RESOURCES,
+                    "observation_tokens": DEFAULT_OBSERVATION_TOKENS,
+                    "result_tokens": DEFAULT_RESULT_TOKENS,
+                    "resume": DEFAULT_RESUME,
+                    "routes": DEFAULT_ROUTES,
+                    "fallback_model": DEFAULT_FALLBACK_MODEL,
+                    "fallback_timeout": DEFAULT_FALLBACK_TIMEOUT,
+                    "step_tools": DEFAULT_STEP_TOOLS,
                     }
             for arg in args.split("--option"):
                 arg = arg.strip()
@@ -193,10 +3257,81 @@ class Agent(llm.Model):
                     else:
                         v = int(v)
                 options[k] = v
-            self._configure(**options)
+            # validating gives the same types, hence pool key, as the
+            # options of the prompts
+            self.pool.get(self.Options(**options).model_dump())
         except Exception as err:
             print(f"Error when configuring early Agent: {err}")
 
+    def _get_options(self, prompt):
+        return {
+                "quiet": prompt.options.quiet,
+                "debug": prompt.options.debug,
+                "openaimodel": prompt.options.openaimodel,
+                "temperature": prompt.options.temperature,
+                "timeout": prompt.options.timeout,
+                "max_iter": prompt.options.max_iter,
+                "validate_subtask": prompt.options.validate_subtask,
+                "user": prompt.options.user,
+                "tavily_tool": prompt.options.tavily_tool,
+                "bigtask_tool": prompt.options.bigtask_tool,
+                "bigtask_workers": prompt.options.bigtask_workers,
+                "metaphor_tool": prompt.options.metaphor_tool,
+                "files_tool": prompt.options.files_tool,
+                "shell_tool": prompt.options.shell_tool,
+                "tool_cache": prompt.options.tool_cache,
+                "llm_cache": prompt.options.llm_cache,
+                "user_memory_k": prompt.options.user_memory_k,
+                "user_memory_tokens": prompt.options.user_memory_tokens,
+                "chat_memory_tokens": prompt.options.chat_memory_tokens,
+                "sub_chat_memory_tokens": prompt.options.sub_chat_memory_tokens,
+                "trace": prompt.options.trace,
+                "cassette": prompt.options.cassette,
+                "cassette_mode": prompt.options.cassette_mode,
+                "max_tokens": prompt.options.max_tokens,
+                "max_cost": prompt.options.max_cost,
+                "openai_rpm": prompt.options.openai_rpm,
+                "meta_search": prompt.options.meta_search,
+                "browser_pages": prompt.options.browser_pages,
+                "browser_block_resources": prompt.options.browser_block_resources,
+                "observation_tokens": prompt.options.observation_tokens,
+                "result_tokens": prompt.options.result_tokens,
+                "resume": prompt.options.resume,
+                "routes": prompt.options.routes,
+                "fallback_model": prompt.options.fallback_model,
+                "fallback_timeout": prompt.options.fallback_timeout,
+                "step_tools": prompt.options.step_tools,
+                }
+
+    def execute(self, prompt, stream, response, conversation):
+        options = self._get_options(prompt)
+
+        # forward to the daemon if it's running, see 'llm agent daemon'
+        sock = connect_daemon() if prompt.prompt != "/debug" else None
+        if sock is not None:
+            yield from daemon_chunks(sock, {
+                "prompt": prompt.prompt,
+                "options": options,
+                "session": getattr(conversation, "id", None),
+                "stream": stream,
+                "cwd": os.getcwd(),
+                })
+            return
+
+        agent = self.pool.get(options)
+        yield from agent.execute(prompt.prompt, stream)
+
+
+class ConfiguredAgent:
+    """The agent, sub_agent and tools built for a given set of options.
+    Instances are created and cached by AgentPool, the resources that are
+    expensive to create are taken from a SharedResources."""
+
+    def __init__(self, options, shared, chat_memory):
+        self.shared = shared
+        self.chat_memory = chat_memory
+        self._configure(**options)
+
     def _configure(
             self,
             quiet,
@@ -207,19 +3342,59 @@ class Agent(llm.Model):
             max_iter,
             validate_subtask,
             bigtask_tool,
+            bigtask_workers,
             user,
             tavily_tool,
             metaphor_tool,
             files_tool,
             shell_tool,
+            tool_cache,
+            llm_cache,
+            user_memory_k,
+            user_memory_tokens,
+            chat_memory_tokens,
+            sub_chat_memory_tokens,
+            trace,
+            cassette,
+            cassette_mode,
+            max_tokens,
+            max_cost,
+            openai_rpm,
+            meta_search,
+            browser_pages,
+            browser_block_resources,
+            observation_tokens,
+            result_tokens,
+            resume,
+            routes,
+            fallback_model,
+            fallback_timeout,
+            step_tools,
+            cwd=None,
+            interactive=True,
             ):
+        """cwd is the directory of the files and shell tools and of the
+        relative paths, the current one if None. The human tool is only
+        given if interactive."""
         from langchain.tools import tool  # for some reason the decorator works only if it's imported in this function :O
+        from langchain.tools import StructuredTool
+        from langchain.agents import load_tools
+        from langchain.agents.agent_types import AgentType
+        from langchain.chains import LLMChain
+        from langchain.prompts import PromptTemplate, MessagesPlaceholder
+        from langchain.memory import ConversationBufferMemory
+        from tqdm import tqdm
+
         self.verbose = not quiet
-        set_verbose(self.verbose)
-        set_debug(debug)
+        self.debug = debug
 
         self.validate_subtask = validate_subtask
+        self.resume = resume
+        self.timeout = timeout
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
         self.bigtask_tool = bigtask_tool
+        self.bigtask_workers = bigtask_workers
 
         if not self.bigtask_tool and self.validate_subtask:
             raise Exception("Can't set validate_subtask to True if bigtask is disabled")
@@ -231,33 +3406,188 @@ class Agent(llm.Model):
             )
         os.environ["OPENAI_API_KEY"] = openai_key
 
-        # load llm
-        chatgpt = ChatOpenAI(
-                model_name=openaimodel,
-                temperature=temperature,
-                verbose=self.verbose,
-                streaming=False,
+        # model and temperature of each role
+        self.routes = {role: (openaimodel, temperature) for role in ROLES}
+        for role, (model, temp) in parse_routes(routes).items():
+            self.routes[role] = (model, temperature if temp is None else temp)
+
+        # cache the completions, only for deterministic answers by default
+        def cached(temp):
+            return llm_cache if llm_cache is not None else temp == 0
+        caching = any(cached(temp) for _, temp in self.routes.values())
+        self.llm_cache = self.shared.get_llm_cache() if caching else None
+
+        # callbacks given to each run of the agent
+        self.role_stats = RoleStats()
+        self.callbacks = [budget_handler(), role_stats_handler(self.role_stats)]
+        if trace:
+            self.callbacks.append(trace_handler(self.shared.get_tracer()))
+        if openai_rpm:
+            self.callbacks.append(rate_limit_handler(self.shared.get_bucket("openai", openai_rpm)))
+
+        # record the LLM requests and tool calls or replay them
+        self.cassette = None
+        if cassette:
+            if cwd is not None:
+                cassette = os.path.join(cwd, cassette)
+            self.cassette = self.shared.get_cassette(cassette, cassette_mode)
+
+        # load the llm of each role, shared by the roles with the same route
+        self.llms = {}
+        loaded = {}
+        for role, (model, temp) in self.routes.items():
+            if (model, temp) not in loaded:
+                loaded[(model, temp)] = self._load_llm(model, temp, bool(cached(temp)), fallback_model, fallback_timeout)
+            self.llms[role] = loaded[(model, temp)]
+        self.chatgpt = chatgpt = self.llms["agent"]
+        # only the tokens of the top level agent are streamed
+        model, temp = self.routes["agent"]
+        self.streaming_llm = self._load_llm(model, temp, bool(cached(temp)), fallback_model, fallback_timeout, streaming=True)
+
+        # declare the heavy tools, they are only loaded when first used
+        self.registry = LazyToolRegistry(verbose=self.verbose)
+        self.registry.declare(
+                "Calculator",
+                "Useful for when you need to answer questions about math.",
+                lambda: load_tools(["llm-math"], llm=chatgpt)[0],
+                )
+        self.registry.declare(
+                "duckduckgo_search",
+                "A wrapper around DuckDuckGo Search. Useful for when you need to answer questions about current events. Input should be a search query.",
+                lambda: load_tools(["ddg-search"], llm=chatgpt)[0],
+                )
+        self.registry.declare(
+                "Wikipedia",
+                "A wrapper around Wikipedia. Useful for when you need to answer general questions about people, places, companies, facts, historical events, or other subjects. Input should be a search query.",
+                lambda: load_tools(["wikipedia"], llm=chatgpt)[0],
+                )
+        self.registry.declare(
+                "arxiv",
+                "A wrapper around Arxiv.org Useful for when you need to answer questions about Physics, Mathematics, Computer Science, Quantitative Biology, Quantitative Finance, Statistics, Electrical Engineering, and Economics from scientific articles on arxiv.org. Input should be a search query.",
+                lambda: load_tools(["arxiv"], llm=chatgpt)[0],
+                )
+
+        def load_pubmed():
+            from langchain.tools import PubmedQueryRun
+            return PubmedQueryRun()
+
+        self.registry.declare(
+                "PubMed",
+                "A wrapper around PubMed. Useful for when you need to answer questions about medicine, health, and biomedical topics from biomedical literature, MEDLINE, life science journals, and online books. Input should be a search query.",
+                load_pubmed,
+                )
+
+        # add tavily search to the tools if possible
+        if tavily_tool:
+            tavily_key = llm.get_key(None, "tavily", env_var="TAVILY_API_KEY")
+            if not tavily_key:
+                print("No Tavily API key given, will only use duckduckgo for search.")
+            else:
+                os.environ["TAVILY_API_KEY"] = tavily_key
+
+                def load_tavily():
+                    from langchain.tools.tavily_search import TavilySearchResults
+                    from langchain.utilities.tavily_search import TavilySearchAPIWrapper
+                    # can only be loaded after the API key was set
+                    tavily_search = TavilySearchAPIWrapper()
+                    return TavilySearchResults(api_wrapper=tavily_search)
+
+                self.registry.declare(
+                        "tavily_search_results_json",
+                        "A search engine optimized for comprehensive, accurate, and trusted results. Useful for when you need to answer questions about current events. Input should be a search query.",
+                        load_tavily,
+                        )
+
+        # add metaphor only if available
+        if metaphor_tool:
+            metaphor_key = llm.get_key(None, "metaphor", env_var="METAPHOR_API_KEY")
+            if not metaphor_key:
+                print("No Metaphor API key given, will not use this search engine.")
+            else:
+                os.environ["METAPHOR_API_KEY"] = metaphor_key
+
+                def load_metaphor():
+                    from metaphor_python import Metaphor
+                    mtph = Metaphor(api_key=os.environ["METAPHOR_API_KEY"])
+
+                    @tool
+                    def metaphor_search(query: str) -> str:
+                        """Advanced search using Metaphor. Use for advanced
+                        topics or if the user asks for it."""
+                        res = mtph.search(query, use_autoprompt=False, num_results=5)
+
+                        contents = res.get_contents().contents
+                        # each result gets its share of the observation
+                        max_chars = min(result_tokens, observation_tokens // max(1, len(contents))) * 4
+                        results = [
+                                f"- {result.url} :\n'''\n{html_to_text(result.extract, max_chars)}\n'''"
+                                for result in contents]
+                        return "Here's the result of the search:\n" + cap_entries(results, observation_tokens)
+
+                    return metaphor_search
+
+                self.registry.declare(
+                        "metaphor_search",
+                        "Advanced search using Metaphor. Use for advanced topics or if the user asks for it.",
+                        load_metaphor,
+                        )
+
+        # add browser toolkit, the browser is only launched when one of
+        # its tool is first used
+        def browser():
+            return self.shared.get_browser(browser_pages, browser_block_resources)
+
+        self.registry.declare(
+                "fetch_pages",
+                "Loads several web pages at once and returns their text. Use it instead of the browser tools when you already know the urls to read.",
+                lambda: fetch_pages_tool(
+                    browser(),
+                    self.shared.get_page_cache() if tool_cache else None,
+                    observation_tokens,
+                    result_tokens),
+                args_schema=fetch_pages_input_schema(),
                 )
+        # tools picked together by the ToolSelector
+        tool_groups = {}
+        try:
+            from langchain.tools import playwright as pw
+
+            for tool_class in [
+                    pw.ClickTool,
+                    pw.NavigateTool,
+                    pw.NavigateBackTool,
+                    pw.ExtractTextTool,
+                    pw.ExtractHyperlinksTool,
+                    pw.GetElementsTool,
+                    pw.CurrentWebPageTool,
+                    ]:
+                fields = tool_class.__fields__
+                name = fields["name"].default
+                tool_groups[name] = "browser"
+                self.registry.declare(
+                        name,
+                        fields["description"].default,
+                        lambda name=name: capped_tool(browser().tools[name], observation_tokens),
+                        args_schema=fields["args_schema"].default,
+                        )
+        except Exception as err:
+            print(f"Error when declaring playwright tool: {err}")
 
         # load some tools
         self.atools = []  # for self.agent
         self.satools = []  # for self.sub_agent
 
-        self.atools += load_tools(["llm-math"], llm=chatgpt)
-        self.atools += load_tools(["human"])
-
-        self.satools += load_tools(["llm-math"], llm=chatgpt)
-        self.satools += load_tools(["human"])
-        self.satools += load_tools(["ddg-search"], llm=chatgpt)
-        self.satools += load_tools(["wikipedia"], llm=chatgpt)
-        self.satools += load_tools(["arxiv"], llm=chatgpt)
-
-        pubmed_tool = PubmedQueryRun()
-        pubmed_tool.description += f"args {pubmed_tool.args}".replace("{", "{{").replace("}", "}}")
-        self.satools.append(pubmed_tool)
+        self.atools += [self.registry.get_tool("Calculator")]
+        self.satools += self.registry.get_tools()
+        # nobody can answer from the terminal of the daemon
+        if interactive:
+            self.atools += load_tools(["human"])
+            self.satools += load_tools(["human"])
 
         if files_tool:
+            from langchain.agents.agent_toolkits import FileManagementToolkit
             toolkit = FileManagementToolkit(
+                    root_dir=cwd,
                     selected_tools=[
                         "read_file",
                         "write_file",
@@ -267,118 +3597,78 @@ class Agent(llm.Model):
                         "copy_file",
                         # "delete_file",
                         ])
-            self.atools.append(toolkit.get_tools())
-            self.satools.append(toolkit.get_tools())
+            self.atools.extend(toolkit.get_tools())
+            self.satools.extend(toolkit.get_tools())
+            tool_groups.update((t.name, "files") for t in toolkit.get_tools())
 
         if shell_tool:
-            self.atools.append(ShellTool())
-            self.satools.append(ShellTool())
-
-        # init memories
-        memory = ConversationBufferMemory(
-                output_key="output",
-                memory_key="chat_history",
-                return_messages=True)
-        # sub_memory = ConversationBufferWindowMemory(
-        #         output_key="output",
-        #         memory_key="chat_history",
-        #         return_messages=True,
-        #         k=2)
-
-        if not user:
-            # just tell the llm the date
-            memory.chat_memory.add_user_message(
-                f"Today's date is {datetime.now()}.")
-        else:
-            # load the date, name of user and previous memories
-            memory.chat_memory.add_user_message(
-                f"My name is {user} and today's date is {datetime.now()}.")
-
-            # look for previous persisted memories
-            llm_agent = llm.user_dir() / "agent"
-            llm_agent.mkdir(exist_ok=True)
-            self.user_memories = llm_agent / f"{user}.json"
-            if not self.user_memories.exists():
-                with open(self.user_memories.absolute(), "w") as file:
-                    json.dump([], file)
-            with open(self.user_memories.absolute(), "r") as file:
-                memories = json.load(file)
-                assert isinstance(memories, list), "Memories is not a list"
-                messages = []
-                for mem in memories:
-                    assert isinstance(mem, dict), "Invalid type of memory"
-                    assert "timestamp" in mem, "Memory missing timestamp key"
-                    assert "message" in mem, "Memory missing message key"
-                    mess = mem["message"]
-                    assert mess, "Empty message in memory"
-                    messages.append(mess)
-                message = ("Here are a few things you have to know:\n- " + "\n- ".join(messages)).strip()
-                if self.verbose:
-                    print(f"Loaded from memory: '{message}")
-                memory.chat_memory.add_user_message(message)
+            self.atools.append(shell_tool_in(cwd))
+            self.satools.append(shell_tool_in(cwd))
+
+        # rate limit the search tools, retry their transient errors and
+        # leave them out of the agents for a while if they keep failing
+        self.satools = [
+                resilient_tool(
+                    t,
+                    self.shared.get_bucket(t.name, TOOL_RPM[t.name], DEFAULT_TOOL_BURST),
+                    self.shared.get_breaker(t.name))
+                if t.name in TOOL_RPM else t
+                for t in self.satools]
+
+        # put a persistent cache in front of the search tools
+        self.tool_cache = None
+        if tool_cache:
+            self.tool_cache = self.shared.get_tool_cache()
+            self.satools = [self.tool_cache.wrap(t) for t in self.satools]
+        if self.cassette is not None:
+            self.satools = [self.cassette.wrap(t) for t in self.satools]
+
+        # a single tool querying all the search tools at once, which
+        # saves the iterations of trying them one after the other
+        if meta_search:
+            backends = [t for t in self.satools if t.name in TOOL_RPM]
+            if backends:
+                self.satools.insert(0, meta_search_tool(backends, self.shared.breakers, observation_tokens, result_tokens))
+
+        # init memories, the chat history is shared by the agent and
+        # sub_agent, and by the other configurations of the conversation,
+        # but each can have its own token budget
+        def agent_memory(max_tokens):
+            kwargs = dict(
+                    chat_memory=self.chat_memory,
+                    output_key="output",
+                    memory_key="chat_history",
+                    return_messages=True)
+            if max_tokens is None:
+                return ConversationBufferMemory(**kwargs)
+            return token_budget_memory_class()(llm=chatgpt, max_tokens=max_tokens, **kwargs)
+
+        self.memory = agent_memory(chat_memory_tokens)
+        self.sub_memory = agent_memory(sub_chat_memory_tokens)
+
+        self.user = user
+        self.memory_index = None
+        if user:
+            # only the memories relevant to each question will be given
+            # to the llm, see _set_preamble
+            self.memory_store = self.shared.get_memory_store()
+            self.memory_index = self.shared.get_memory_index(user, self.verbose)
+            self.user_memory_k = user_memory_k
+            self.user_memory_tokens = user_memory_tokens
 
             @tool
             def memorize(memory: str) -> str:
                 """Use this ONLY if the user asks you to memorize an information
                 persistently. I'll then make sure to store it somewhere for future use
                 by you. Input must be the information the user wants you to memorize."""
-                with open(self.user_memories.absolute(), "r") as file:
-                    memories = json.load(file)
-                    memories.append({
-                            "timestamp": int(time.time()),
-                            "message": memory,
-                            })
-                with open(self.user_memories.absolute(), "w") as file:
-                    json.dump(memories, file)
+                self.memory_store.add(user, memory)
+                self.memory_index.add(memory)
                 return f"I added the memory '{memory}' to persistent memory."
 
             self.atools.append(memorize)
 
-        # add tavily search to the tools if possible
-        if tavily_tool:
-            tavily_key = llm.get_key(None, "tavily", env_var="TAVILY_API_KEY")
-            os.environ["TAVILY_API_KEY"] = tavily_key
-            if not tavily_key:
-                print("No Tavily API key given, will only use duckduckgo for search.")
-            else:
-                # can only be loaded after the API key was set
-                tavily_search = TavilySearchAPIWrapper()
-                tavily_tool = TavilySearchResults(api_wrapper=tavily_search)
-                self.satools.append(tavily_tool)
-
-        # add metaphor only if available
-        if metaphor_tool:
-            metaphor_key = llm.get_key(None, "metaphor", env_var="METAPHOR_API_KEY")
-            os.environ["METAPHOR_API_KEY"] = metaphor_key
-            if not metaphor_key:
-                print("No Metaphor API key given, will not use this search engine.")
-            else:
-                mtph = Metaphor(api_key=os.environ["METAPHOR_API_KEY"])
-
-                @tool
-                def metaphor_search(query: str) -> str:
-                    """Advanced search using Metaphor. Use for advanced
-                    topics or if the user asks for it."""
-                    res = mtph.search(query, use_autoprompt=False, num_results=5)
-
-                    output = "Here's the result of the search:"
-                    for result in res.get_contents().contents:
-                        html = result.extract
-                        url = result.url
-                        text = BeautifulSoup(html).get_text().strip()
-                        output += f"\n- {url} :\n'''\n{text}\n'''\n"
-                    output = output.strip()
-                    return output
-
-                self.satools.append(metaphor_search)
-
-        # add browser toolkit
-        try:
-            self.browser = create_sync_playwright_browser()
-            toolkit = PlayWrightBrowserToolkit.from_browser(sync_browser=self.browser)
-            self.satools.extend(toolkit.get_tools())
-        except Exception as err:
-            print(f"Error when creating playwright tool: {err}")
+        if self.cassette is not None:
+            self.atools = [self.cassette.wrap(t) for t in self.atools]
 
         if self.bigtask_tool:
             template = dedent("""
@@ -387,15 +3677,18 @@ class Agent(llm.Model):
             If the question is already phrased as a series of steps, just rewrite into the appropriate format.
             Use your tools to answer the question.
 
+            Independent steps will be done in parallel so for each step, list the number of the previous steps whose answer it needs, or 'none'.
+
             ALWAYS answer using the appropriate format.
-            APPROPRIATE FORMAT: one step per line, without enumeration.
+            APPROPRIATE FORMAT: one numbered step per line, followed by ' | needs: ' and the numbers of the steps it needs.
 
             Example of format:
             ```
-            Find the name of the owner of MacDonald's
-            Find his age
-            Multiply it by 4
-            Return the answer
+            1. Find the name of the owner of MacDonald's | needs: none
+            2. Find his age | needs: 1
+            3. Find the population of France | needs: none
+            4. Multiply his age by the population of France | needs: 2, 3
+            5. Return the answer | needs: 4
             ```
 
             Your turn now:
@@ -405,81 +3698,119 @@ class Agent(llm.Model):
                 template=template,
             )
             subtasker = LLMChain(
-                llm=chatgpt,
+                llm=self.llms["planner"],
                 prompt=prompt,
                 output_key="steps",
                 verbose=self.verbose,
+                tags=["planner", "role:planner"],
             )
 
-            @tool
-            def BigTask(question: str) -> str:
+            def BigTask(question: str, callbacks=None) -> str:
                 """If you have a task requiring multiple steps, use
                 this tool. If the task is directly from the user: give
                 me his exact instructions without any reformulation."""
                 question = question.replace("The end goal it to answer this:", "").strip()
-                steps = subtasker(question)["steps"].splitlines()
-
-                header = f"The end goal it to answer this: '{question}'.\n\n"
-                header += "Here is the task planning:"
-                for i, step in enumerate(steps):
-                    step = f"\n{i+1}. {step}. Done: 'STEPANSWER'"
-                    header += step
-
-                answers = []
-                intermediate_stepanswers = []
-                for i, step in tqdm(enumerate(steps), desc="Executing complicated task", unit="step"):
-                    stepprompt = header
-                    for ans in answers:
-                        stepprompt = stepprompt.replace("STEPANSWER", ans, 1)
-                    stepprompt = stepprompt.replace("Done: 'STEPANSWER'", "TODO", 1).strip()
-                    stepprompt = stepprompt.replace("Done: 'STEPANSWER'", "LATER").strip()
-
-                    stepprompt += f"\n\nYour current task is #{i+1}"
+                checkpoint = self._checkpoint(question)
+                if checkpoint.plan is not None and self.resume:
+                    plan = checkpoint.plan
+                else:
+                    plan = parse_plan(subtasker(question, callbacks=callbacks)["steps"])
+                    checkpoint.start(plan)
+
+                def run_step(i, answers):
+                    stepprompt = plan_prompt(question, plan, answers, current=i)
                     print(stepprompt)
+                    budget = self._step_budget(len(plan) - len(answers))
 
                     try:
-                        answerdict = self.sub_agent(stepprompt)
-                    except Exception as err:
-                        print(f"Error {err}, retrying after 2s")
-                        time.sleep(2)
-                        answerdict = self.sub_agent(stepprompt)
-                        if self.validate_subtask:
-                            answerdict = self._validate_answer(stepprompt, answerdict)
-
-                    answers.append(answerdict["output"])
-                    intermediate_stepanswers.append(answerdict["intermediate_steps"])
-
-                prompt = header
-                for ans in answers:
-                    prompt = prompt.replace("STEPANSWER", ans, 1)
-                prompt += "\n\nNow please answer the initial question."
-                answerdict = self.sub_agent(prompt)
+                        # any error is retried, the sub_agent being rebuilt
+                        # without the tools that keep failing
+                        answerdict = with_retries(
+                                lambda: self._step_agent(plan[i][0])(stepprompt, callbacks=callbacks),
+                                retries=DEFAULT_STEP_RETRIES,
+                                retry_if=lambda err: True)
+                    except BudgetExceeded as err:
+                        # only the step's share is exhausted
+                        if err.budget is not budget:
+                            raise
+                        answerdict = {"output": f"Step not finished: {err}", "intermediate_steps": [], "unfinished": True}
+                    return answerdict
+
+                def validate(i, answers, answerdict):
+                    # run in the background, the next steps use the answer meanwhile
+                    if looks_valid(answerdict):
+                        return answerdict
+                    stepprompt = plan_prompt(question, plan, answers, current=i)
+                    return self._validate_answer(stepprompt, answerdict, callbacks=callbacks)
+
+                with tqdm(total=len(plan), desc="Executing complicated task", unit="step") as progress:
+                    results = run_plan(plan, run_step, self.bigtask_workers, progress, validate if self.validate_subtask else None, checkpoint)
+                answers = [results[i]["output"] for i in range(len(plan))]
+                intermediate_stepanswers = [results[i]["intermediate_steps"] for i in range(len(plan))]
+
+                prompt = plan_prompt(question, plan, dict(enumerate(answers)))
+                answerdict = self._step_agent(question, "synthesis")(prompt, callbacks=callbacks)
+                answers.append(answerdict["output"])
+                intermediate_stepanswers.append(answerdict["intermediate_steps"])
+                checkpoint.remove()
+
+                return bigtask_answer([step for step, deps in plan], answers)
+
+            async def aBigTask(question: str, callbacks=None) -> str:
+                question = question.replace("The end goal it to answer this:", "").strip()
+                checkpoint = await asyncio.to_thread(self._checkpoint, question)
+                if checkpoint.plan is not None and self.resume:
+                    plan = checkpoint.plan
+                else:
+                    plan = parse_plan((await subtasker.acall(question, callbacks=callbacks))["steps"])
+                    checkpoint.start(plan)
+
+                async def run_step(i, answers):
+                    stepprompt = plan_prompt(question, plan, answers, current=i)
+                    print(stepprompt)
+                    budget = self._step_budget(len(plan) - len(answers))
+
+                    try:
+                        answerdict = await awith_retries(
+                                lambda: self._step_agent(plan[i][0]).acall(stepprompt, callbacks=callbacks),
+                                retries=DEFAULT_STEP_RETRIES,
+                                retry_if=lambda err: True)
+                    except BudgetExceeded as err:
+                        if err.budget is not budget:
+                            raise
+                        answerdict = {"output": f"Step not finished: {err}", "intermediate_steps": [], "unfinished": True}
+                    return answerdict
+
+                async def validate(i, answers, answerdict):
+                    if looks_valid(answerdict):
+                        return answerdict
+                    stepprompt = plan_prompt(question, plan, answers, current=i)
+                    return await self._avalidate_answer(stepprompt, answerdict, callbacks=callbacks)
+
+                with tqdm(total=len(plan), desc="Executing complicated task", unit="step") as progress:
+                    results = await arun_plan(plan, run_step, self.bigtask_workers, progress, validate if self.validate_subtask else None, checkpoint)
+                answers = [results[i]["output"] for i in range(len(plan))]
+                intermediate_stepanswers = [results[i]["intermediate_steps"] for i in range(len(plan))]
+
+                prompt = plan_prompt(question, plan, dict(enumerate(answers)))
+                answerdict = await self._step_agent(question, "synthesis").acall(prompt, callbacks=callbacks)
                 answers.append(answerdict["output"])
                 intermediate_stepanswers.append(answerdict["intermediate_steps"])
+                checkpoint.remove()
 
-                final_answer = f"Assistant, return the complete following text as the final answer instead of just extracting the last few lines like you used to:\n'''\nI split the question into intermediate steps then tried to reason step by step.\nSteps:\n"
-                for i, step in enumerate(steps):
-                    step = f"\n{i+1}. {step}. Answer:\n"
-                    step += textwrap.indent(answers[i], "    ")
-                    step = step.replace(r"\\n", "\n")
-                    final_answer += step
-                final_answer += f"\nThe answer is: '{answers[-1]}'\n'''"
-
-                return final_answer
-
-            self.sub_agent = initialize_agent(
-                    llm=chatgpt,
-                    tools=self.satools,
-                    verbose=self.verbose,
-                    agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
-                    # agent=AgentType.CHAT_CONVERSATIONAL_REACT_DESCRIPTION,
-                    memory=memory,
-                    handle_parsing_errors=True,
-                    max_execution_time=DEFAULT_TIMEOUT,
-                    max_iterations=DEFAULT_MAX_ITER,
-                    return_intermediate_steps=True,
+                return bigtask_answer([step for step, deps in plan], answers)
+
+            # the callbacks are given by langchain so that the sub_agent
+            # calls are nested in the BigTask run, e.g. for streaming
+            BigTask = StructuredTool.from_function(
+                    func=BigTask,
+                    coroutine=aBigTask,
+                    description="BigTask(question: str) -> str - " + dedent(BigTask.__doc__).strip(),
                     )
 
+            # sync only tools are run in a thread when called asynchronously
+            self.satools = [with_async_fallback(t) for t in self.satools]
+
             # only add to the tools now so that sub_agent can't make recursive bigtask calls
             self.atools += [BigTask]
 
@@ -517,106 +3848,389 @@ class Agent(llm.Model):
             template=template,
         )
         self.validity_checker = LLMChain(
-            llm=chatgpt,
+            llm=self.llms["validator"],
             prompt=prompt,
             output_key="check",
             verbose=self.verbose,
+            tags=["validation", "role:validator"],
         )
 
-        self.agent = initialize_agent(
-                llm=chatgpt,
-                tools=self.atools,
+        self.atools = [with_async_fallback(t) for t in self.atools]
+
+        # the agents are built by _agent_with, once per role and set of tools
+        self.agent_kwargs = dict(
                 verbose=self.verbose,
                 # agent=AgentType.CHAT_CONVERSATIONAL_REACT_DESCRIPTION,
                 agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
-                memory=memory,
                 handle_parsing_errors=True,
-                max_execution_time=DEFAULT_TIMEOUT,
-                max_iterations=DEFAULT_MAX_ITER,
+                max_execution_time=timeout,
+                max_iterations=max_iter,
                 return_intermediate_steps=True,
+                # the structured chat agent only sees the history if asked to
+                agent_kwargs=dict(
+                    memory_prompts=[MessagesPlaceholder(variable_name="chat_history")],
+                    input_variables=["input", "agent_scratchpad", "chat_history"]),
                 )
+        self.agents = {}
+        self.agents_lock = threading.Lock()
 
-        print(f"(Tools as the agent's disposal: {', '.join([t.name for t in self.atools])})")
-        if bigtask_tool:
-            print(f"(Tools at the disposal of BigTask's agent: {', '.join([t.name for t in self.satools])})")
+        # the agent of each BigTask step only gets the tools relevant to it
+        self.tool_selector = None
+        if self.bigtask_tool and step_tools:
+            self.tool_selector = ToolSelector(self.satools, step_tools, tool_groups)
 
-        self.configured = True
+        # built now rather than during the first question, the agents of
+        # the steps depend on their tools
+        self.agent
+        if self.bigtask_tool and self.tool_selector is None:
+            self.sub_agent
+            self.synthesis_agent
 
-    def execute(self, prompt, stream, response, conversation):
-        question = prompt.prompt
-        options = {
-                "quiet": prompt.options.quiet,
-                "debug": prompt.options.debug,
-                "openaimodel": prompt.options.openaimodel,
-                "temperature": prompt.options.temperature,
-                "timeout": prompt.options.timeout,
-                "max_iter": prompt.options.max_iter,
-                "validate_subtask": prompt.options.validate_subtask,
-                "user": prompt.options.user,
-                "tavily_tool": prompt.options.tavily_tool,
-                "bigtask_tool": prompt.options.bigtask_tool,
-                "metaphor_tool": prompt.options.metaphor_tool,
-                "files_tool": prompt.options.files_tool,
-                "shell_tool": prompt.options.shell_tool,
-                }
+        if self.verbose:
+            print(f"(Tools as the agent's disposal: {', '.join([t.name for t in self.atools])})")
+            if bigtask_tool:
+                print(f"(Tools at the disposal of BigTask's agent: {', '.join([t.name for t in self.satools])})")
 
-        if not self.configured:
-            self._configure(**options)
+    def _agent_with(self, tools, memory, role, streaming=False):
+        """agent of role using the tools whose circuit breaker is closed,
+        built only once for each set of available tools"""
+        from langchain.agents.initialize import initialize_agent
+        breakers = self.shared.breakers
+        tools = [t for t in tools if t.name not in breakers or breakers[t.name].available()]
+        key = (role, id(memory), tuple(t.name for t in tools), streaming)
+        with self.agents_lock:
+            if key not in self.agents:
+                if any(k[:2] == key[:2] and k[3] == key[3] for k in self.agents) and self.verbose:
+                    print(f"(Agent built with the tools: {', '.join(t.name for t in tools)})")
+                self.agents[key] = initialize_agent(
+                        tools=tools,
+                        memory=memory,
+                        llm=self.streaming_llm if streaming else self.llms[role],
+                        tags=[f"role:{role}"],
+                        **self.agent_kwargs)
+            return self.agents[key]
 
-        with get_openai_callback() as cb:
-            if question == "/debug":
-                breakpoint()
-                return "Done with debugging"
+    @property
+    def agent(self):
+        return self._agent_with(self.atools, self.memory, "agent")
 
-            if stream:
-                raise NotImplementedError("Streaming response is currently buggy.")
-                answerdict = self.agent.stream(question)
-                for chunk in answerdict:
-                    if chunk["intermediate_steps"]:
-                        yield chunk["intermediate_steps"]
-                    yield chunk["output"]
-                if self.verbose:
-                    print(f"\nToken so far: {cb.total_tokens} or ${cb.total_cost}")
-                return
+    @property
+    def streaming_agent(self):
+        "the agent, with its LLM streaming its tokens"
+        return self._agent_with(self.atools, self.memory, "agent", streaming=True)
+
+    @property
+    def sub_agent(self):
+        "agent doing the steps of BigTask"
+        return self._agent_with(self.satools, self.sub_memory, "step")
 
+    @property
+    def synthesis_agent(self):
+        "agent giving the final answer of BigTask from the answers of the steps"
+        return self._agent_with(self.satools, self.sub_memory, "synthesis")
+
+    def _step_agent(self, text, role="step"):
+        "sub_agent with only the tools relevant to text, see the step_tools option"
+        if self.tool_selector is None:
+            return self._agent_with(self.satools, self.sub_memory, role)
+        return self._agent_with(self.tool_selector.select(text), self.sub_memory, role)
+
+    def _load_llm(self, model, temperature, cache, fallback_model, fallback_timeout, streaming=False):
+        "chat model of a route, falling back to fallback_model if set"
+        if fallback_model and fallback_model != model:
+            chat = fallback_chat_model_class()(
+                    primary=self.shared.get_llm(model, temperature, cache, self.verbose, timeout=fallback_timeout, streaming=streaming),
+                    fallback=self.shared.get_llm(fallback_model, temperature, cache, self.verbose, streaming=streaming),
+                    breaker=self.shared.get_breaker(f"llm:{model}"),
+                    cache=cache,
+                    streaming=streaming,
+                    )
+        else:
+            chat = self.shared.get_llm(model, temperature, cache, self.verbose, streaming=streaming)
+        if self.cassette is not None:
+            chat = self.cassette.wrap_llm(chat)
+        return chat
+
+    def _checkpoint(self, question):
+        "Checkpoint of the BigTask of question, see the resume option"
+        checkpoints = self.shared.agent_dir() / "checkpoints"
+        checkpoints.mkdir(exist_ok=True)
+        checkpoint = Checkpoint(checkpoints / f"{hashlib.sha256(question.encode()).hexdigest()[:32]}.jsonl")
+        if checkpoint.plan is not None:
+            if self.resume:
+                print(f"(Resuming BigTask from its checkpoint, {len(checkpoint.results)}/{len(checkpoint.plan)} steps already done)")
             else:
-                answerdict = self.agent(question)
+                # kept aside rather than overwritten by the new BigTask
+                old = checkpoint.path.with_suffix(".old")
+                checkpoint.path.replace(old)
+                checkpoint.load()
+                print(f"(This BigTask was interrupted before, starting it again. Its checkpoint is kept in {old},"
+                        f" rename it to {checkpoint.path.name} and use '-o resume true' to continue it instead)")
+        return checkpoint
+
+    def _format_answer(self, answerdict):
+        if answerdict["intermediate_steps"]:
+            full_answer = "Intermediate steps:\n"
+            for i, s in enumerate(answerdict["intermediate_steps"]):
+                full_answer += f"* {i+1}: {s}\n"
+            full_answer += f"\n-> {answerdict['output']}"
+            return full_answer
+        else:
+            return answerdict["output"]
+
+    def _set_preamble(self, question):
+        """Put at the start of the conversation the pinned messages of this
+        configuration: the date, the name of the user and the persistent
+        memories relevant to the question. They replace those of the
+        previous question, which may have used other options."""
+        from langchain.globals import set_verbose, set_debug
+        from langchain.schema import HumanMessage
+        # those are global to langchain
+        set_verbose(self.verbose)
+        set_debug(self.debug)
+
+        # only the date so that the prompts stay the same for the LLM cache
+        if self.user:
+            preamble = [f"My name is {self.user} and today's date is {datetime.now().date()}."]
+        else:
+            preamble = [f"Today's date is {datetime.now().date()}."]
 
+        if self.memory_index is not None:
+            t = time.time()
+            selected = select_memories(self.memory_index, question, self.user_memory_k, self.user_memory_tokens)
+            if selected:
+                message = ("Here are a few things you have to know:\n- " + "\n- ".join(selected)).strip()
                 if self.verbose:
-                    print(f"\nToken so far: {cb.total_tokens} or ${cb.total_cost}")
-
-                if answerdict["intermediate_steps"]:
-                    full_answer = "Intermediate steps:\n"
-                    for i, s in enumerate(answerdict["intermediate_steps"]):
-                        full_answer += f"* {i+1}: {s}\n"
-                    full_answer += f"\n-> {answerdict['output']}"
-                    return full_answer
-                else:
-                    return answerdict["output"]
+                    print(f"Loaded from memory in {time.time() - t:.3f}s: '{message}")
+                preamble.append(message)
 
-    def _validate_answer(self, question, answerdict, depth=0):
-        "used to double check results. Can get very expensive"
+        messages = self.chat_memory.messages
+        messages[:] = [
+                HumanMessage(content=content, additional_kwargs={"pinned": True})
+                for content in preamble
+                ] + [m for m in messages if not m.additional_kwargs.get("pinned")]
+
+    @contextlib.contextmanager
+    def _budget(self):
+        "a new budget for the question being answered"
+        token = CURRENT_BUDGET.set(Budget(self.timeout, self.max_tokens, self.max_cost))
         try:
-            check = self.validity_checker(question=question, answer=answerdict["output"])
+            yield
+        finally:
+            CURRENT_BUDGET.reset(token)
+
+    def _step_budget(self, steps_left):
+        """Give the BigTask step being run its share of the time left: the
+        steps left and the final answer are done in waves of
+        bigtask_workers steps. Each step runs in its own context so the
+        budget doesn't need to be reset."""
+        budget = CURRENT_BUDGET.get()
+        if budget is None:
+            return None
+        budget = budget.split(math.ceil((steps_left + 1) / self.bigtask_workers))
+        CURRENT_BUDGET.set(budget)
+        return budget
+
+    def answer(self, question, callbacks=None):
+        "returns the answerdict of the agent and its openai callback"
+        from langchain.callbacks import get_openai_callback
+
+        self._set_preamble(question)
+        with get_openai_callback() as cb, self._budget():
+            answerdict = self.agent(question, callbacks=(callbacks or []) + self.callbacks)
+        return answerdict, cb
+
+    def execute(self, question, stream):
+        from langchain.callbacks import get_openai_callback
+
+        self._set_preamble(question)
+
+        with get_openai_callback() as cb, self._budget():
+            if question == "/debug":
+                breakpoint()
+                yield "Done with debugging"
+                return
+
+            if stream:
+                yield from self._stream(question)
+            else:
+                answerdict = self.agent(question, callbacks=self.callbacks)
+                yield self._format_answer(answerdict)
+
+            if self.verbose:
+                print(f"\nToken so far: {cb.total_tokens} or ${cb.total_cost}")
+                if self.tool_cache is not None:
+                    print(self.tool_cache.stats)
+                if self.llm_cache is not None:
+                    print(self.llm_cache.stats)
+                print(self.role_stats.stats)
+
+    def _stream(self, question):
+        """Run the agent in a thread and yield its intermediate steps and
+        the tokens of its final answer as they come."""
+        events = queue.Queue()
+        done = object()
+        handler = stream_handler(events.put)
+        result = {}
+
+        def run():
+            try:
+                result["answerdict"] = self.streaming_agent(question, callbacks=[handler] + self.callbacks)
+            except Exception as err:
+                result["error"] = err
+            finally:
+                events.put(done)
+
+        # keep get_openai_callback working in the thread
+        ctx = contextvars.copy_context()
+        thread = threading.Thread(target=ctx.run, args=(run,), daemon=True)
+        thread.start()
+        event = events.get()
+        while event is not done:
+            yield event
+            event = events.get()
+        thread.join()
+
+        if "error" in result:
+            raise result["error"]
+        if not handler.streamed_answer:
+            yield f"\n-> {result['answerdict']['output']}"
+
+    async def aexecute(self, question):
+        """Async counterpart of execute: the agent, BigTask's sub_agent,
+        planner, validity checker and tools are all awaited so that many
+        questions can be answered concurrently from one event loop.
+        Returns the formatted answer."""
+        from langchain.callbacks import get_openai_callback
+
+        self._set_preamble(question)
+
+        with get_openai_callback() as cb, self._budget():
+            answerdict = await self.agent.acall(question, callbacks=self.callbacks)
+
             if self.verbose:
-                print(f"Validity checker output: {check}")
+                print(f"\nToken so far: {cb.total_tokens} or ${cb.total_cost}")
+                if self.tool_cache is not None:
+                    print(self.tool_cache.stats)
+                if self.llm_cache is not None:
+                    print(self.llm_cache.stats)
+                print(self.role_stats.stats)
+
+        return self._format_answer(answerdict)
+
+    async def astream(self, question):
+        "async counterpart of _stream"
+        self._set_preamble(question)
+
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        done = object()
+        # sync handlers can be called from langchain's executor threads
+        handler = stream_handler(lambda event: loop.call_soon_threadsafe(events.put_nowait, event))
+
+        async def run():
+            try:
+                return await self.streaming_agent.acall(question, callbacks=[handler] + self.callbacks)
+            finally:
+                loop.call_soon_threadsafe(events.put_nowait, done)
 
-            assert ":" in check, f"check is missing: '{check}'"
-            state = check.split(":")[0]
-            reason = ":".join(check.split(":")[1:])
-            assert state in ["VALID", "INVALID"], f"Invalid state: '{state}'"
+        with self._budget():
+            task = asyncio.ensure_future(run())
+        event = await events.get()
+        while event is not done:
+            yield event
+            event = await events.get()
+        answerdict = await task
+
+        if not handler.streamed_answer:
+            yield f"\n-> {answerdict['output']}"
+
+    def _parse_check(self, check):
+        "returns the state and reason given by the validity checker"
+        if self.verbose:
+            print(f"Validity checker output: {check}")
+
+        assert ":" in check, f"check is missing: '{check}'"
+        state = check.split(":")[0].strip()
+        reason = ":".join(check.split(":")[1:])
+        assert state in ["VALID", "INVALID"], f"Invalid state: '{state}'"
+        return state, reason
+
+    def _retry_prompt(self, question, answerdict, reason):
+        return (
+                f"To the question '{question}' you answered "
+                f"'{answerdict['output']}' which is invalid because "
+                f"'{reason}'. Try again.")
+
+    def _validate_answer(self, question, answerdict, depth=0, callbacks=None):
+        "used to double check results. Can get very expensive"
+        try:
+            check = self.validity_checker.predict(
+                    question=question,
+                    answer=answerdict["output"],
+                    callbacks=callbacks)
+            state, reason = self._parse_check(check)
 
             if state == "INVALID":
                 new_answerdict = self.sub_agent(
-                        f"To the question '{question}' you answered "
-                        f"'{answerdict['output']}' which is invalid because "
-                        f"'{reason}'. Try again.")
+                        self._retry_prompt(question, answerdict, reason),
+                        callbacks=callbacks)
                 if depth >= 1:
                     return new_answerdict
                 else:
                     # recursive call:
-                    return self._validate_answer(question, new_answerdict, depth+1)
+                    return self._validate_answer(question, new_answerdict, depth+1, callbacks)
+            else:
+                return answerdict
+        except BudgetExceeded:
+            raise
+        except Exception as err:
+            print(f"Error when checking validity: '{err}'")
+            return answerdict
+
+    async def _avalidate_answer(self, question, answerdict, depth=0, callbacks=None):
+        "async version of _validate_answer"
+        try:
+            check = await self.validity_checker.apredict(
+                    question=question,
+                    answer=answerdict["output"],
+                    callbacks=callbacks)
+            state, reason = self._parse_check(check)
+
+            if state == "INVALID":
+                new_answerdict = await self.sub_agent.acall(
+                        self._retry_prompt(question, answerdict, reason),
+                        callbacks=callbacks)
+                if depth >= 1:
+                    return new_answerdict
+                else:
+                    return await self._avalidate_answer(question, new_answerdict, depth+1, callbacks)
             else:
                 return answerdict
+        except BudgetExceeded:
+            raise
         except Exception as err:
             print(f"Error when checking validity: '{err}'")
+            return answerdict
+
+
+if hasattr(llm, "AsyncModel"):
+    class AsyncAgent(llm.AsyncModel):
+        """Async model registered next to Agent for the versions of llm
+        that support it, it shares the pool of configured agents of the sync Agent."""
+        model_id = "agent"
+        can_stream = True
+        Options = Agent.Options
+
+        def __init__(self, agent):
+            self.sync_agent = agent
+
+        async def execute(self, prompt, stream, response, conversation):
+            options = self.sync_agent._get_options(prompt)
+            # configuring imports langchain and can block for a while
+            agent = await asyncio.to_thread(self.sync_agent.pool.get, options)
+            if stream:
+                async for chunk in agent.astream(prompt.prompt):
+                    yield chunk
+            else:
+                yield await agent.aexecute(prompt.prompt)
@@ -0,0 +1,87 @@
+import llm_agent
+
+FINAL_ANSWER = 'Action:\n```\n{"action": "Final Answer", "action_input": "Done."}\n```'
+
+
+def recording_chat_model(received):
+    from langchain.chat_models.base import BaseChatModel
+    from langchain.schema import AIMessage, ChatGeneration, ChatResult
+
+    class RecordingChatModel(BaseChatModel):
+        "fake LLM keeping the messages it is given"
+        streaming: bool = False
+        model_name: str = "recording"
+
+        @property
+        def _llm_type(self):
+            return "recording"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            received.append(messages)
+            return ChatResult(
+                    generations=[ChatGeneration(message=AIMessage(content=FINAL_ANSWER))],
+                    llm_output={"token_usage": {}, "model_name": self.model_name},
+                    )
+
+    return RecordingChatModel()
+
+
+class RecordingResources(llm_agent.SharedResources):
+    def __init__(self):
+        super().__init__()
+        self.received = []
+
+    def get_llm(self, model, temperature, cache, verbose, timeout=None, streaming=False):
+        return recording_chat_model(self.received)
+
+
+def configure(tmp_path, monkeypatch, **options):
+    monkeypatch.setenv("LLM_USER_PATH", str(tmp_path))
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    shared = RecordingResources()
+    options = llm_agent.Agent.Options(quiet=True, tool_cache=False, llm_cache=False, **options)
+    return shared, llm_agent.AgentPool(shared=shared).get(options.model_dump())
+
+
+def test_budgeted_history_is_sent(tmp_path, monkeypatch):
+    from langchain.schema import AIMessage, HumanMessage
+    shared, agent = configure(tmp_path, monkeypatch, chat_memory_tokens=300)
+    for i in range(20):
+        agent.chat_memory.add_message(HumanMessage(content=f"Question {i}: " + "blah " * 20))
+        agent.chat_memory.add_message(AIMessage(content=f"Answer {i}: " + "blah " * 20))
+    # as if the background summarization had folded the first 30 messages
+    agent.memory.summary = "The user likes tuna."
+    agent.memory.summarized = 30
+    agent._set_preamble("What should I eat?")
+    expected = agent.memory.load_memory_variables({})["chat_history"]
+
+    agent.answer("What should I eat?")
+
+    messages = shared.received[0]
+    contents = [m.content for m in messages]
+    assert messages[0].type == "system" and "You have access to the following tools" in contents[0]
+    assert contents[-1].startswith("What should I eat?")
+    assert messages[1:-1] == expected
+    assert contents[1].startswith("Today's date is ")
+    assert "Summary of the earlier conversation:\nThe user likes tuna." in contents
+    assert any(c.startswith("Answer 19: ") for c in contents)
+    # the summarized messages are not sent again
+    assert not any(c.startswith(("Question 0: ", "Answer 14: ")) for c in contents)
+    assert llm_agent.approx_tokens("".join(c for c in contents[1:-1])) <= 300
+
+
+def test_relevant_memories_are_sent(tmp_path, monkeypatch):
+    monkeypatch.setenv("LLM_USER_PATH", str(tmp_path))
+    store = llm_agent.SharedResources().get_memory_store()
+    for i in range(200):
+        store.add("bob", f"Unrelated fact number {i} about the weather in town {i}.")
+    store.add("bob", "Bob's cat is named Tom.")
+    store.add("bob", "Bob is allergic to cats.")
+    shared, agent = configure(tmp_path, monkeypatch, user="bob", user_memory_k=2, user_memory_tokens=100)
+
+    agent.answer("What is the name of my cat?")
+
+    contents = [m.content for m in shared.received[0]]
+    assert contents[1].startswith("My name is bob and today's date is ")
+    memories = [c for c in contents if c.startswith("Here are a few things you have to know:")]
+    assert memories == ["Here are a few things you have to know:\n- Bob's cat is named Tom.\n- Bob is allergic to cats."]
@@ -0,0 +1,18 @@
+import json
+
+import llm_agent
+
+
+def stream(blob, size):
+    "the final answer streamed from blob cut into tokens of size chars"
+    answer_stream = llm_agent.FinalAnswerStream()
+    return "".join(answer_stream.feed(blob[i:i + size]) for i in range(0, len(blob), size))
+
+
+def test_json_escapes_are_decoded():
+    answer = 'café\r\n\t"quoted" back\\slash /slash \U0001F600 中文 \U0001F44D\U0001F3FD'
+    blob = "Action:\n```\n" + json.dumps({"action": "Final Answer", "action_input": answer}) + "\n```"
+    assert "\\u00e9" in blob and "\\ud83d\\ude00" in blob
+    # the escape sequences are split between tokens
+    for size in range(1, 8):
+        assert stream(blob, size) == answer
@@ -0,0 +1,47 @@
+import asyncio
+
+import llm_agent
+
+
+def failing_tool(calls):
+    from langchain.tools import StructuredTool
+
+    def search(query: str) -> str:
+        "fake duckduckgo"
+        calls.append(query)
+        if len(calls) == 1:
+            raise ValueError("search engine down")
+        return f"results for {query}"
+
+    return StructuredTool.from_function(search, name="duckduckgo_search")
+
+
+def cached_resilient_tool(tmp_path, calls):
+    cache = llm_agent.ToolCache(tmp_path / "tool_cache.db")
+    tool = llm_agent.resilient_tool(
+            failing_tool(calls),
+            llm_agent.TokenBucket(1e9, 1e9),
+            llm_agent.CircuitBreaker())
+    return cache, cache.wrap(tool)
+
+
+def test_failed_call_is_not_cached(tmp_path):
+    calls = []
+    cache, tool = cached_resilient_tool(tmp_path, calls)
+
+    assert tool.run({"query": "Hello?"}).startswith("The tool duckduckgo_search failed")
+    assert tool.run({"query": "Hello?"}) == "results for Hello?"
+    assert len(calls) == 2
+    # the successful call is cached
+    assert tool.run({"query": "Hello?"}) == "results for Hello?"
+    assert len(calls) == 2
+    assert cache.hits == 1
+
+
+def test_failed_async_call_is_not_cached(tmp_path):
+    calls = []
+    cache, tool = cached_resilient_tool(tmp_path, calls)
+
+    assert asyncio.run(tool.arun({"query": "Hello?"})).startswith("The tool duckduckgo_search failed")
+    assert asyncio.run(tool.arun({"query": "Hello?"})) == "results for Hello?"
+    assert len(calls) == 2